@@ -353,7 +353,10 @@ class XJOBMain(wax.Frame):
 		"""
 		Event:
 			While the application is idle, redraw box/volume text
+			(after running the display commands the pipelines queued up)
 		"""
+		self.callback.process()
+
 		if len(self.inlist.retexts + self.outlist.retexts) == 0:
 			event.Skip()
 			return
@@ -372,6 +375,7 @@ class XJOBMain(wax.Frame):
 		# kill all threads and exit
 		exit(1)
 
-# do main loop stuff
-app = wax.Application(XJOBMain, title='XJOB Processor', direction='vertical')
-app.Run()
+# do main loop stuff (guarded so pipeline process pools can import us)
+if __name__ == "__main__":
+	app = wax.Application(XJOBMain, title='XJOB Processor', direction='vertical')
+	app.Run()
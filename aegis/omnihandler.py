@@ -4,13 +4,15 @@
 # Eric Ritezel -- March 04, 2007
 #
 
-import threading
+import Queue
 
 class OmniHandler(object):
 	"""
 	The OmniHandler class provides a far-reaching, thread-safe hook base
 	into the display.  It interprets incoming information from Pipeline
 	Plugin objects and also feeds back into them.
+	Pipeline threads only queue their commands up; the GUI thread runs
+	them against the widgets with process() (XJOBMain.ListUpdate does).
 
 	It is mean.  It will take your lunch money.  It doesn't like your sister.
 	"""
@@ -22,11 +24,11 @@ class OmniHandler(object):
 		self.statusbar = statusbar
 		self.manager = manager
 
-		# define error list
-		self.__errors = []
+		# define blacklist (targets that have errored or been removed)
+		self.__blacklist = set()
 
-		# define RLock for thread-safety
-		self.threadlock = threading.RLock()
+		# (target, command words, value) waiting for the GUI thread
+		self.commands = Queue.Queue()
 
 	def dispatch(self, target, command, value=None):
 		"""
@@ -45,31 +47,56 @@ class OmniHandler(object):
 			to kill itself.
 			The given UUID will then be blacklisted, and further attempts on it
 			will be met with False before any operations happen.
+			(Errors and removals blacklist the target right away; anything the
+			display finds wrong later blacklists it once process() gets there.)
 		"""
-		# do the threading thing
-		self.threadlock.acquire()
-
 		# we know this to be bad, so return False
-		if target in self.__errors: return False
+		if target in self.__blacklist: return False
 
 		# parse out command string (lower case, space-separated)
 		cmd = command.lower().split()
 
+		# queue it up for the display (this never blocks)
+		self.commands.put((target, cmd, value))
+
+		# errors and removals are the end of the target
+		if 'error' in cmd or 'remove' in cmd:
+			self.__blacklist.add(target)
+			return False
+
+		return True
+
+	def process(self, limit=1000):
+		"""
+		Run queued commands against the display (from the GUI thread only),
+		up to limit of them so a flood can't hold the GUI up.
+		Returns:
+			the number of commands run
+		"""
+		count = 0
+		while count < limit:
+			try: target, cmd, value = self.commands.get(block=False)
+			except Queue.Empty: break
+			self.__Run(target, cmd, value)
+			count += 1
+		return count
+
+	def __Run(self, target, cmd, value):
+		""" Run one command against the display widgets. """
 		# handle an error/warning/information command
 		if 'error' in cmd:
 			self.statusbar.AddError(value)
 			self.inlist.FlagError(target)
-			self.__errors.append(target)
-			return False
+			return
 
 		# this is a non-destructive event, but we still can't do much else
 		else:
-			if 'warning' in cmd:
+			if 'warning' in cmd or 'warn' in cmd:
 				self.statusbar.AddWarning(value)
-				return True
+				return
 			elif 'information' in cmd:
 				self.statusbar.AddInformation(value)
-				return True
+				return
 
 		# run a remove command
 		if 'remove' in cmd:
@@ -83,11 +110,8 @@ class OmniHandler(object):
 			if len(self.inlist) == 0:
 				self.statusbar.VolumeWaiting()
 
-			# add the target to the error list
-			self.__errors.append(target)
-
-			# return False in case this is a plugin and it needs a hint
-			return False
+			# (dispatch already blacklisted the target, and told the plugin)
+			return
 
 		###################################
 		##
@@ -125,7 +149,7 @@ class OmniHandler(object):
 			else:
 				self.statusbar.AddError('Target "'+ target + \
 				                        '" tried to close before initialization.')
-				self.__errors.append(target)
+				self.__blacklist.add(target)
 			self.statusbar.VolumeReady()
 
 		# finalize source (stop updating and set final display mode)
@@ -176,6 +200,3 @@ class OmniHandler(object):
 			else:
 				self.statusbar.AddWarning('Target "'+ target + \
 				                          '" referenced before initialization.')
-
-		# do the threading thing
-		self.threadlock.release()
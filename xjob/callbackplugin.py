@@ -2,10 +2,15 @@
 # Eric Ritezel -- March 04, 2007
 #
 
-import xml.etree.ElementTree as ET
+import threading, xml.etree.ElementTree as ET
 
 import plugin
 
+# commands whose values just add up, so a batch can send its total
+additive = ('add source documents', 'add source size', 'add source donedocuments',
+            'add destination documents', 'add destination size',
+            'add complete destination documents')
+
 class CallbackOrDie(plugin.Plugin):
 	"""
 	A Pipeline plugin to dispatch calls using the OmniHandler protocol.
@@ -13,12 +18,17 @@ class CallbackOrDie(plugin.Plugin):
 		CallbackOrDie(<commands for OmniHandler>,
 		               validate=<true/false fcn>,
 		               value=<scalar value>,
+		               select=<true/false fcn>,
 		               callback=<OmniHandler instance>)
 	
 	The default validator passes True on everything,
 	and the default value is None.
+	Items the selector turns down pass by without a call (it takes everything
+	by default).
 	If the command is none, the initialization fails.
+	Additive commands go out once per target per batch, with the total.
 	"""
+	batchsize = 64
 	
 	def Init(self, *args, **kwargs):
 		# set the OmniHandler instance
@@ -29,6 +39,7 @@ class CallbackOrDie(plugin.Plugin):
 		# set up the validator and the value
 		self.validator = kwargs.get('validate', lambda x: True)
 		self.value = kwargs.get('value', lambda x: None)
+		self.select = kwargs.get('select', lambda x: True)
 
 		# set up the command
 		self.command = kwargs.get('command', False)
@@ -37,6 +48,10 @@ class CallbackOrDie(plugin.Plugin):
 				self.comamnd = args[-1]
 			else:
 				raise ValueError("Command for OmniHandler not set")
+
+	def canhandle(self, xjob):
+		""" Only call out for the items we were told to. """
+		return self.select(xjob)
 			
 	def handle(self, level, xjob):
 		"""
@@ -60,3 +75,137 @@ class CallbackOrDie(plugin.Plugin):
 		
 		# otherwise, the full value passes through
 		yield xjob
+
+	def handle_batch(self, level, xjobs):
+		"""
+		Validate each xjob, but (for additive commands) throw one total per
+		target at OmniHandler instead of a value per xjob
+		"""
+		if ' '.join(self.command.lower().split()) not in additive:
+			for output in plugin.Plugin.handle_batch(self, level, xjobs): yield output
+			return
+
+		# validation failures still get told right away
+		totals = {}
+		targets = []
+		for xjob in xjobs:
+			target = xjob.find('source').get('id')
+			if not self.validator(xjob):
+				self.callback.dispatch(target, 'warn', 'Validation failed against ' + \
+				              str(target) + ' at "' + self.command + '" stage.')
+
+			if not totals.has_key(target):
+				totals[target] = 0
+				targets.append(target)
+			totals[target] += int(self.value(xjob))
+
+		for target in targets:
+			if self.callback.dispatch(target, self.command, totals[target]) is False:
+				self.callback.dispatch(target, 'warn', 'Callback failed against ' + \
+				              str(target) + ' at "' + self.command + '" stage.')
+
+		# the xjobs pass through either way (as they do from handle)
+		for xjob in xjobs: yield xjob
+
+class BufferedDispatcher(object):
+	"""
+	Sits in front of an OmniHandler so the pipelines don't hit its lock (and
+	its widgets) for every item.  Additive commands are added up per target
+	and sent as totals every interval seconds, or once threshold of them have
+	piled up.  Any other command sends its target's totals first, then goes
+	through as usual, all under the lock so no flush can slip in between;
+	warnings and other reports go straight through.
+	Targets the OmniHandler has said False to get False from then on.
+	"""
+	reports = ('warn', 'warning', 'information', 'error')
+
+	def __init__(self, callback, interval=0.25, threshold=256):
+		self.callback = callback
+		self.interval = interval
+		self.threshold = threshold
+
+		# target -> {command: total}, and how many adds went in since the last flush
+		self.pending = {}
+		self.count = 0
+		self.lock = threading.RLock()
+
+		# targets the OmniHandler has refused
+		self.failed = set()
+
+		# send the totals on a timer, too
+		self.stopped = threading.Event()
+		self.timer = threading.Thread(target=self.__Tick, name="Callback-Flush")
+		self.timer.setDaemon(True)
+		self.timer.start()
+
+	def dispatch(self, target, command, value=None):
+		"""
+		Add up or pass on a command (see OmniHandler.dispatch).
+		Returns:
+			True for a buffered command, otherwise the OmniHandler's answer
+			(False, as ever, if the target is bad)
+		"""
+		if target in self.failed: return False
+		cmd = command.lower().split()
+		name = ' '.join(cmd)
+
+		# add it to the target's totals (sending everything if that's plenty)
+		if name in additive:
+			self.lock.acquire()
+			try:
+				commands = self.pending.setdefault(target, {})
+				commands[name] = commands.get(name, 0) + int(value)
+				self.count += 1
+				full = self.count >= self.threshold
+			finally: self.lock.release()
+
+			if full: self.flush()
+			return True
+
+		# reports go right away
+		if [word for word in cmd if word in self.reports]:
+			return self.__Send(target, command, value)
+
+		# anything else goes after the target's totals
+		self.lock.acquire()
+		try:
+			self.flush(target)
+			return self.__Send(target, command, value)
+		finally: self.lock.release()
+
+	def flush(self, target=None):
+		"""
+		Send the totals for one target (or all of them), holding the lock
+		until they're sent, so they can't pass (or be passed by) a command
+		that follows them.
+		"""
+		self.lock.acquire()
+		try:
+			if target is None:
+				pending = self.pending.items()
+				self.pending = {}
+				self.count = 0
+			elif self.pending.has_key(target):
+				pending = [(target, self.pending.pop(target))]
+			else: return
+
+			for target, commands in pending:
+				for command, value in commands.iteritems():
+					if target not in self.failed: self.__Send(target, command, value)
+		finally: self.lock.release()
+
+	def close(self):
+		""" Stop the timer and send whatever's left. """
+		self.stopped.set()
+		self.timer.join()
+		self.flush()
+
+	def __Send(self, target, command, value):
+		""" Hand a command to the OmniHandler, noting targets it refuses. """
+		result = self.callback.dispatch(target, command, value)
+		if result is False: self.failed.add(target)
+		return result
+
+	def __Tick(self):
+		""" Flush every interval seconds until we're closed. """
+		while not self.stopped.wait(self.interval): self.flush()
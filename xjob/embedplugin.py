@@ -72,18 +72,21 @@ class EmbedPlugin(plugin.Plugin, object):
 
 	def canhandle(self, xjob):
 		""" See if a) we can actually run Embedding and b) if it needs it. """
-		print "hit embed handler with haveimage:", _HaveImage, " canEmbed:", self.canEmbed, " ops/Embed", self.settings['operations/Embed']
-		return _HaveImage and self.canEmbed and self.settings['operations/Embed'] is not None
+		if __debug__:
+			print "hit embed handler with haveimage:", _HaveImage, " canEmbed:", self.canEmbed, " ops/Embed", self.settings['operations/Embed']
+		return _HaveImage and self.canEmbed and self.settings['operations/Embed'] is not None \
+		       and xjob.get('complete', None) is None
 
 	def handle(self, level, xjob):
 		""" Embed an xjob object. """
 		# see if our settings revision checks out, fetch settings otherwise
-		rev = int(self.settings.getrevision())
+		settings = self.settings.snapshot()
+		rev = int(settings.revision)
 		if self.revision != rev:
 			self.revision = rev
 
 			# grab Rotation preference
-			if self.settings['operations/RotateLandscape'] is not None:
+			if settings['operations/RotateLandscape'] is not None:
 				self.rotatelandscape = True
 			else: self.rotatelandscape = False
 
@@ -91,7 +94,7 @@ class EmbedPlugin(plugin.Plugin, object):
 			# FIXME: need good interface for this
 			embednames=('level', 'horizontal', 'vertical', 'type', 'attribute', 'value')
 			self.masterembeds = [zip(embednames, es.split(',')) for es in \
-			                     self.settings['operations/EmbedStrings'].split(';')]
+			                     settings['operations/EmbedStrings'].split(';')]
 
 		# get the basepath for file-level interaction
 		basepath = xjob.find('source').get('temphref', xjob.find('source').get('href'))
@@ -0,0 +1,289 @@
+# Lines/sec for the Opticon and IPRO readers: the baseline Read() (copied
+# verbatim below) against the streaming readers, with the streaming readers
+# also run on the baseline's per-field group() calls and uuid4 ids, to show
+# what the parse and id changes are worth on their own
+# usage: python -O benchmark.py [lines]
+# (-O, since the baseline's TreeBuilder calls trip ElementTree's asserts
+#  when a volume changes mid-document)
+#
+
+import os, sys, time, uuid, tempfile
+import xml.etree.ElementTree as ET
+
+from ipro import IPRO
+from opticon import Opticon
+
+class UUIDs:
+	""" The baseline's id source: a fresh uuid4 for everything. """
+	def next(self):
+		return str(uuid.uuid4())
+
+def Groups(result, *names):
+	""" The baseline's field access: a group() call per field. """
+	return tuple([result.group(name) for name in names])
+
+class BaselineOpticon(Opticon):
+	""" Opticon's baseline Read(), verbatim (readlines twice, TreeBuilder). """
+	def Parse(self, line):
+		result = self.regex.search(line)
+		if not result: return None
+		return Groups(result, 'name', 'volume', 'path', 'file', 'break')
+
+	def Read(self, filename):
+		# fire up the loadfile in text mode
+		self.loadfile = open(filename, 'r')
+		basepath = os.path.dirname(filename)
+
+		# build base of tree
+		build = ET.TreeBuilder()
+		root = build.start("xjob",{})
+		volume = build.start("source",{'href':basepath, 'id':str(uuid.uuid4()), 'type':'opticon'})
+
+		# kick off tree-depth tracking stack (we need this for back-references)
+		tree = []
+		tree.append(root)
+
+		# initialize number of lines and errors
+		linenum = 0
+		linerrs = []
+
+		# get hint for readlines
+		self.loadfile.readlines()
+		hint = self.loadfile.tell()
+		self.loadfile.seek(0)
+
+		# read lines from Opticon
+		for line in self.loadfile.readlines(hint):
+			# increment line number
+			linenum+= 1
+
+			# parse line
+			result = self.regex.search(line)
+
+			# complain about result
+			if not result:
+				linerrs.append(linenum, line)
+				continue
+
+			# try to assign the volume one of our values
+			if not volume.attrib.has_key("name"):
+				volume.attrib["name"] = result.group("volume")
+
+			# otherwise see if we should start a new volume
+			elif volume.attrib["name"] != result.group("volume"):
+				build.end("source")
+				volume = build.start("source", {'href':basepath,
+				                                'id':str(uuid.uuid4()),
+				                                'name':result.group('volume'),
+				                                'type':'opticon'})
+
+			# if there's a break, create a new document
+			if result.group("break").strip() == "Y":
+				if tree[-1].tag == "document":
+					build.end("document")
+					tree.pop()
+				tree.append(build.start("document",{'id':str(uuid.uuid4())}))
+
+			# start a new page element
+			pgnode = build.start("page",{'id':str(uuid.uuid4()), 'name':result.group("name")})
+			ET.SubElement(pgnode, 'number', {'type':'bates', 'value':result.group("name")})
+			ET.SubElement(pgnode, 'data', {'path':result.group("path").strip(os.path.sep),
+			                               'filename':result.group("file")})
+			build.end("page")
+
+		# close up processing
+		build.end("document")
+		build.end("source")
+		build.end("xjob")
+
+		# generate xml output
+		self.XML = build.close()
+		self.loadfile.close()
+
+		self.lines = linenum
+
+class BaselineIPRO(IPRO):
+	""" IPRO's baseline Read(), verbatim (readlines twice, TreeBuilder). """
+	def Parse(self, line):
+		result = self.regex.search(line)
+		if not result: return None
+		return Groups(result, 'type', 'name', 'break', 'volume', 'path', 'file')
+
+	def Read(self, filename):
+		# fire up the loadfile in text mode
+		self.loadfile = open(filename, 'r')
+		basepath = os.path.dirname(filename)
+
+		# build base of tree
+		build = ET.TreeBuilder()
+		root = build.start("xjob",{})
+		volume = build.start("source",{'href':basepath, 'id':str(uuid.uuid4()), 'type':'ipro'})
+
+		# kick off tree-depth tracking stack (we need this for back-references)
+		tree = []
+		tree.append(root)
+
+		# initialize number of lines and errors
+		linenum = 0
+		linerrs = []
+
+		# get hint for readlines
+		self.loadfile.readlines()
+		hint = self.loadfile.tell()
+		self.loadfile.seek(0)
+
+		# read lines from LFP
+		for line in self.loadfile.readlines(hint):
+			# increment line number
+			linenum+= 1
+
+			# parse line
+			result = self.regex.search(line)
+
+			# complain about result
+			if not result:
+				linerrs.append(linenum, line)
+				continue
+
+			# see if we're getting an image key definition line
+			# TODO: add Fulltext and Information Only handlers
+			if result.group("type") != "IM": continue
+
+			# try to assign the volume one of our values
+			if not volume.attrib.has_key("name"):
+				volume.attrib["name"] = result.group("volume")
+
+			# otherwise see if we should start a new volume
+			elif volume.attrib["name"] != result.group("volume"):
+				build.end("source")
+				volume = build.start("source", {'href':basepath,
+				                                'id':str(uuid.uuid4()),
+				                                'name':result.group('volume'),
+				                                'type':'ipro'})
+
+			# if there's a break, create a new document and structure
+			# FIXME: assumes D/C as the hierarchy
+			if result.group("break").strip() != "":
+				if tree[-1].tag == "document":
+					build.end("document")
+					
+					# see if we can move the node to a parent now
+					if tree[-1].has_key('parent'):
+						# find parent for attachment vector
+						mommy = [x for x in tree[-2].getchildren().reverse() \
+						         if x.get('id') == tree[-1].get('parent')][0]
+							
+						# find/make attachment node
+						attachnode = mommy.find('attachment') 
+						if attachnode is None:
+							attachnode = ET.SubElement(mommy, 'attachment')
+						
+						# move node
+						attachnode.append(tree[-1])
+						mommy.remove(tree[-1])
+
+					tree.pop()
+				
+				# append document to node and try 
+				tree.append(build.start("document",{'id':str(uuid.uuid4())}))
+
+				# set "last true document"
+				if result.group("break").strip() == "D":
+					lastdoc = tree[-1].get('id')
+				elif result.group("break").strip() == "C":
+					tree[-1].attrib['parent'] = lastdoc
+
+
+			# start a new page element
+			pgnode = build.start("page",{'id':str(uuid.uuid4()), 'name':result.group("name")})
+			ET.SubElement(pgnode, 'number', {'type':'bates', 'value':result.group("name")})
+			ET.SubElement(pgnode, 'data', {'path':result.group("path").strip(os.path.sep),
+										   'filename':result.group("file")})
+			build.end("page")
+
+		# close up processing
+		build.end("document")
+		build.end("source")
+		build.end("xjob")
+
+		# generate xml output
+		self.XML = build.close()
+		self.loadfile.close()
+
+		self.lines = linenum
+
+class UUIDOpticon(BaselineOpticon):
+	""" The streaming Opticon reader on the baseline's group() calls and uuid4 ids. """
+	def __init__(self):
+		Opticon.__init__(self)
+		self.ids = UUIDs()
+
+class UUIDIPRO(BaselineIPRO):
+	""" The streaming IPRO reader on the baseline's group() calls and uuid4 ids. """
+	def __init__(self):
+		IPRO.__init__(self)
+		self.ids = UUIDs()
+
+def WriteOpticon(filename, lines):
+	""" A loadfile of 4-page documents, 100,000 pages to a volume. """
+	loadfile = open(filename, 'w')
+	for i in xrange(lines):
+		loadfile.write('AIR %08d,AIRDM%02d,Q:\\AIRDM%02d\\AIR\\AIR%05d\\AIR%08d.TIF,%s,,,\n' % \
+		               (i, i / 100000, i / 100000, i / 1000, i, (i % 4 == 0) and 'Y' or ''))
+	loadfile.close()
+
+def WriteIPRO(filename, lines):
+	""" A loadfile of 4-page documents (every third with an attachment). """
+	loadfile = open(filename, 'w')
+	for i in xrange(lines):
+		brk = (i % 4 == 0) and 'D' or ((i % 12 == 2) and 'C' or '')
+		loadfile.write('IM,MAI%08d,%s,0,@MAI%03d;%04d;MAI%08d.tif;2\n' % \
+		               (i, brk, i / 100000, i / 1000, i))
+	loadfile.close()
+
+def Time(loader, filename, lines, streaming):
+	"""
+	Run through a loadfile, returning (lines/sec to parse, lines/sec to
+	read it all, through Iterate() if streaming or Read() if not).
+	"""
+	loadfile = open(filename, 'r')
+	start = time.time()
+	for line in loadfile: loader.Parse(line)
+	parse = time.time() - start
+	loadfile.close()
+
+	start = time.time()
+	if streaming:
+		for fragment in loader.Iterate(filename): pass
+	else: loader.Read(filename)
+	build = time.time() - start
+	if getattr(loader, 'linerrs', None):
+		raise ValueError("%d bad lines" % len(loader.linerrs))
+
+	return lines / parse, lines / build
+
+if __name__ == "__main__":
+	lines = len(sys.argv) > 1 and int(sys.argv[1]) or 1000000
+	tempdir = tempfile.mkdtemp()
+
+	try:
+		for name, write, baseline, uuids, new in \
+		    (('Opticon', WriteOpticon, BaselineOpticon, UUIDOpticon, Opticon),
+		     ('IPRO', WriteIPRO, BaselineIPRO, UUIDIPRO, IPRO)):
+			filename = os.path.join(tempdir, name.lower())
+			write(filename, lines)
+
+			print "%s, %d lines" % (name, lines)
+			for label, loader, streaming in (('baseline Read()', baseline(), False),
+			                                 ('stream, uuid4', uuids(), True),
+			                                 ('stream', new(), True)):
+				# (the baseline IPRO reader can't get past its second document:
+				#  it calls has_key on an Element)
+				try: parse, build = Time(loader, filename, lines, streaming)
+				except Exception, e:
+					print "  %-16s failed: %s: %s" % (label, e.__class__.__name__, e)
+					continue
+				print "  %-16s parse %10.0f lines/sec   read %10.0f lines/sec" % \
+				      (label, parse, build)
+			os.remove(filename)
+	finally: os.rmdir(tempdir)
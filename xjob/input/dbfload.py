@@ -3,9 +3,10 @@
 # adds dictionary mapping
 # adds iteration
 # v0.1.0 -- Major cleanup and switch to struct module (20070227)
+# adds memory-mapped batch reads
 #
 
-import struct
+import struct, mmap, itertools
 
 class DbfLoader:
 	"""
@@ -23,13 +24,19 @@ class DbfLoader:
 		self.allRecords
 		self.allRecordsAsDict
 		self.recordStatus
+	For big tables, batches() and rows() decode straight out of a memory map
+	with one precompiled struct per record.
+	Given a list of (mapped) field names, records only carry those fields.
 	"""
 
-	def __init__(self, mapterms=None):
+	def __init__(self, mapterms=None, fields=None):
 		# set storage list for field definitions and copy mapping terms
 		self.fieldDefs = []
 		self.fieldMap = (mapterms is not None and (mapterms,) or ({},))[0]
 
+		# the fields to decode (None for all of them)
+		self.fields = fields
+
 		# set file name
 		self.dbfs = None
 
@@ -74,8 +81,64 @@ class DbfLoader:
 		# read additional junk data
 		self.dbfs.read(1)
 
+		# the fields we'll actually decode
+		self.columns = [fd for fd in self.fieldDefs
+		                if self.fields is None or fd.name in self.fields]
+
+		# whole-record layout: delete flag, every field (skipping the ones we
+		# don't want), then any slack
+		if start > self.recordLength:
+			raise ValueError("Fields overrun the record length: " + filename)
+		self.record = struct.Struct('x' + \
+		              ''.join([(fd in self.columns and '%ds' or '%dx') % fd.length
+		                       for fd in self.fieldDefs]) + \
+		              '%dx' % (self.recordLength - start))
+
+		# names and decoders for the fields that need more than slicing
+		self.names = [fd.name for fd in self.columns]
+		self.decoders = [(i, decode) for i, decode in
+		                 enumerate([fd.decoder() for fd in self.columns])
+		                 if decode is not None]
+
+		# the fields that come out as strings
+		self.strings = [fd.name for fd in self.columns if fd.decoder() is None]
+
 		return self
 
+	def batches(self, size=4096):
+		"""
+		Generate the records a batch at a time from a memory map of the file.
+		Parameters:
+			size -- records per batch
+		Returns:
+			lists of up to size dictionary rows (the same rows next() makes)
+		"""
+		if not self.recordCount: return
+
+		records = mmap.mmap(self.dbfs.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			# pull everything we'll use into locals
+			unpack = self.record.unpack_from
+			length = self.recordLength
+			names = self.names
+			decoders = self.decoders
+
+			for first in xrange(0, self.recordCount, size):
+				batch = []
+				offset = self.headerLength + first * length
+				for i in xrange(first, min(first + size, self.recordCount)):
+					values = list(unpack(records, offset))
+					for field, decode in decoders: values[field] = decode(values[field])
+					batch.append(dict(itertools.izip(names, values)))
+					offset += length
+				yield batch
+		finally: records.close()
+
+	def rows(self, size=4096):
+		""" Generate the records one at a time, read in batches. """
+		for batch in self.batches(size):
+			for row in batch: yield row
+
 	def close(self):
 		"""
 		Clean up after dbfs and variables
@@ -95,7 +158,7 @@ class DbfLoader:
 
 			# decode data and append to dictionary
 			dictrec = {}
-			for fd in self.fieldDefs:
+			for fd in self.columns:
 				dictrec.update(fd.decodeValue(rawrec))
 
 			retval.append(dictrec)
@@ -119,7 +182,7 @@ class DbfLoader:
 
 		# decode data and append to dictionary
 		dictrec = {}
-		for fd in self.fieldDefs:
+		for fd in self.columns:
 			dictrec.update(fd.decodeValue(rawrec))
 
 		# return one dictionary row of data
@@ -209,3 +272,25 @@ class DbfFieldDef (object):
 				if (rawval=='.'): rawval = 0.0
 				else: rawval = float(rawval)
 		return {self.name: rawval}
+
+	def decoder(self):
+		"""
+		Get a function that turns this field's raw string into its value
+		(the same way decodeValue does), or None if the raw string is it.
+		"""
+		if self.type != 'N': return None
+		if self.decimalCount == 0: return _DecodeInteger
+		return lambda rawval: _DecodeDecimal(rawval, self.decimalCount)
+
+def _DecodeInteger(rawval):
+	""" Decode a numeric field with no decimal places. """
+	rawval = rawval.strip()
+	if not len(rawval): return 0
+	try: return int(rawval)
+	except ValueError: return long(rawval)
+
+def _DecodeDecimal(rawval, decimalCount):
+	""" Decode a numeric field with decimal places. """
+	rawval = rawval[:-decimalCount].strip() + '.' + rawval[-decimalCount:]
+	if rawval == '.': return 0.0
+	return float(rawval)
@@ -7,8 +7,8 @@
 # v0.9.9 -- Making changes to work with Pipeline expected output 20070225
 #
 
-import os, uuid, ConfigParser, xml.etree.ElementTree as ET
-import glob
+import os, sys, uuid, ConfigParser, xml.etree.ElementTree as ET
+import glob, itertools, threading, Queue
 from dbfload import *
 
 class Doculex:
@@ -120,21 +120,63 @@ class Doculex:
 		self.cp.readfp(inifile)
 		inifile.close()
 
-		# get mapping terms and open data files with them
+		# get mapping terms and open data files with them (only decoding
+		# the columns we've got a use for)
 		terms = self._LoadINI(self.cp)
-		dclx = DbfLoader(terms)
+		dclx = DbfLoader(terms, set(terms.values()))
 		dclx.open(dlexMain)
 
-		indx = DbfLoader(terms)
+		indx = DbfLoader(terms, set(terms.values()))
 		indx.open(dlexIndex)
 
 		# load data from structure and close up
-		self._LoadData(iter(dclx), iter(indx), path)
-		dclx.close()
-		indx.close()
+		try: self._LoadData(self._Rows(dclx, indx), path)
+		finally:
+			dclx.close()
+			indx.close()
 
 		return self
 
+	def _Rows(self, dclx, indx, size=4096):
+		"""
+		Generate the joined doculex5/indices5 rows (strings stripped),
+		decoding indices5 on a thread while doculex5 decodes here.
+		Both tables are read in batches of the same size, so the batches
+		line up; the join stops at the end of the shorter table.
+		"""
+		batches = Queue.Queue(4)
+		stop = threading.Event()
+		strings = set(dclx.strings) | set(indx.strings)
+
+		def Put(item):
+			""" Hand over a batch unless the reader has quit on us. """
+			while not stop.isSet():
+				try: return batches.put(item, True, 0.25)
+				except Queue.Full: continue
+
+		def Decode():
+			""" Decode indices5 into batches (None at the end, or the error). """
+			try:
+				for batch in indx.batches(size): Put(batch)
+				Put(None)
+			except: Put(sys.exc_info())
+
+		decoder = threading.Thread(target=Decode, name="Doculex-Index")
+		decoder.setDaemon(True)
+		decoder.start()
+
+		try:
+			for batch in dclx.batches(size):
+				more = batches.get()
+				if more is None: return
+				if isinstance(more, tuple): raise more[0], more[1], more[2]
+
+				for row, extra in itertools.izip(batch, more):
+					row.update(extra)
+					for name in strings: row[name] = row[name].strip()
+					yield row
+		finally: stop.set()
+
 	def _LoadINI(self, config):
 		"""
 		Process the JobProfi.ini file contents being passed in.
@@ -168,13 +210,12 @@ class Doculex:
 
 		return terms
 
-	def _LoadData(self, dclx, indx, path):
+	def _LoadData(self, rows, path):
 		"""
 		pull the doculex data
 
 		Parameters:
-			dclx -- a dictionary-like element populated by doculex5.dbf
-			indx -- a dictionary-like element populated by indices5.dbf
+			rows -- an iterator of rows joined from doculex5.dbf/indices5.dbf
 			path -- a relative path to the dbfs (usually the image root too)
 		"""
 
@@ -198,11 +239,7 @@ class Doculex:
 		tree = [self.XML]
 
 		# run the main doculex data pull
-		row = dclx.next()
-		row.update(indx.next())
-
-		# map strip to all fields
-		row.update(zip(row.keys(), map(lambda x: x.strip(), row.itervalues())))
+		row = next(rows, None)
 
 		# set the document counter up
 		doc_count = 1
@@ -212,14 +249,7 @@ class Doculex:
 
 		while row is not None:
 			# preload next row for document-ending lookahead
-			try:
-				nextrow = dclx.next()
-				nextrow.update(indx.next())
-
-				# map strip to all fields
-				nextrow.update(zip(nextrow.keys(), map(lambda x: x.strip(), nextrow.itervalues())))
-			except:
-				nextrow = None
+			nextrow = next(rows, None)
 
 			# reset singleton flag
 			singleton = False
@@ -5,6 +5,7 @@
 
 import os, re, glob, uuid
 from xml.etree import ElementTree as ET
+from sequence import IdSequence
 
 class IPRO:
 	"""
@@ -37,6 +38,9 @@ class IPRO:
 		# compile regular expression
 		self.regex = re.compile(expression, re.VERBOSE)
 
+		# source/document/page ids
+		self.ids = IdSequence()
+
 	def getvalidname(self, filename):
 		""" See if we can load a given path. """
 		if not os.path.exists(filename): return None
@@ -58,107 +62,116 @@ class IPRO:
 		return None
 
 	def Read(self, filename):
-		# fire up the loadfile in text mode
-		self.loadfile = open(filename, 'r')
-		basepath = os.path.dirname(filename)
+		""" Load the whole loadfile into one xjob tree (self.XML). """
+		self.XML = ET.Element("xjob")
 
-		# build base of tree
-		build = ET.TreeBuilder()
-		root = build.start("xjob",{})
-		volume = build.start("source",{'href':basepath, 'id':str(uuid.uuid4()), 'type':'ipro'})
+		# stitch the streamed documents back under their sources
+		sources = {}
+		for srcnode in self.Iterate(filename):
+			if srcnode.get('reconstruct') is not None: continue
+			if not sources.has_key(srcnode.get('id')):
+				sources[srcnode.get('id')] = ET.SubElement(self.XML, 'source', srcnode.attrib)
+			for docnode in list(srcnode): sources[srcnode.get('id')].append(docnode)
 
-		# kick off tree-depth tracking stack (we need this for back-references)
-		tree = []
-		tree.append(root)
+		return self
+
+	def Iterate(self, filename):
+		"""
+		Read the loadfile a line at a time, generating each document (with its
+		attachments) as soon as it's complete, as
+		<source ...><document>...</document></source>.
+		Each source finishes with its master, a <source reconstruct="True">
+		holding an empty <document id="..." /> for every document, in order,
+		for AssembleSourcePlugin to put back together.
+		"""
+		# fire up the loadfile in text mode
+		loadfile = open(filename, 'r')
+		basepath = os.path.dirname(filename)
 
 		# initialize number of lines and errors
-		linenum = 0
-		linerrs = []
-
-		# get hint for readlines
-		self.loadfile.readlines()
-		hint = self.loadfile.tell()
-		self.loadfile.seek(0)
-
-		# read lines from LFP
-		for line in self.loadfile.readlines(hint):
-			# increment line number
-			linenum+= 1
-
-			# parse line
-			result = self.regex.search(line)
-
-			# complain about result
-			if not result:
-				linerrs.append(linenum, line)
-				continue
-
-			# see if we're getting an image key definition line
-			# TODO: add Fulltext and Information Only handlers
-			if result.group("type") != "IM": continue
-
-			# try to assign the volume one of our values
-			if not volume.attrib.has_key("name"):
-				volume.attrib["name"] = result.group("volume")
-
-			# otherwise see if we should start a new volume
-			elif volume.attrib["name"] != result.group("volume"):
-				build.end("source")
-				volume = build.start("source", {'href':basepath,
-				                                'id':str(uuid.uuid4()),
-				                                'name':result.group('volume'),
-				                                'type':'ipro'})
-
-			# if there's a break, create a new document and structure
-			# FIXME: assumes D/C as the hierarchy
-			if result.group("break").strip() != "":
-				if tree[-1].tag == "document":
-					build.end("document")
-					
-					# see if we can move the node to a parent now
-					if tree[-1].has_key('parent'):
-						# find parent for attachment vector
-						mommy = [x for x in tree[-2].getchildren().reverse() \
-						         if x.get('id') == tree[-1].get('parent')][0]
-							
-						# find/make attachment node
-						attachnode = mommy.find('attachment') 
-						if attachnode is None:
-							attachnode = ET.SubElement(mommy, 'attachment')
-						
-						# move node
-						attachnode.append(tree[-1])
-						mommy.remove(tree[-1])
-
-					tree.pop()
-				
-				# append document to node and try 
-				tree.append(build.start("document",{'id':str(uuid.uuid4())}))
-
-				# set "last true document"
-				if result.group("break").strip() == "D":
-					lastdoc = tree[-1].get('id')
-				elif result.group("break").strip() == "C":
-					tree[-1].attrib['parent'] = lastdoc
-
-
-			# start a new page element
-			pgnode = build.start("page",{'id':str(uuid.uuid4()), 'name':result.group("name")})
-			ET.SubElement(pgnode, 'number', {'type':'bates', 'value':result.group("name")})
-			ET.SubElement(pgnode, 'data', {'path':result.group("path").strip(os.path.sep),
-										   'filename':result.group("file")})
-			build.end("page")
-
-		# close up processing
-		build.end("document")
-		build.end("source")
-		build.end("xjob")
-
-		# generate xml output
-		self.XML = build.close()
-		self.loadfile.close()
-
-		self.lines = linenum
+		self.lines = 0
+		self.linerrs = []
+
+		# the current source's attributes and master, the open top-level
+		# document and the document (or attachment) pages are going into
+		attribs = master = docnode = current = None
+
+		try:
+			# read lines from LFP
+			for line in loadfile:
+				# increment line number
+				self.lines += 1
+
+				# parse line
+				result = self.Parse(line)
+
+				# complain about result
+				if result is None:
+					self.linerrs.append((self.lines, line))
+					continue
+				type, name, brk, volume, path, filename = result
+
+				# see if we're getting an image key definition line
+				# TODO: add Fulltext and Information Only handlers
+				if type != "IM": continue
+
+				# see if we should start a new volume (and finish the last)
+				if attribs is None or attribs['name'] != volume:
+					if docnode is not None: yield self._Fragment(attribs, docnode)
+					if master is not None: yield master
+					docnode = current = None
+
+					attribs = {'href':basepath, 'id':self.ids.next(),
+					           'name':volume, 'type':'ipro'}
+					master = ET.Element("source", attribs, reconstruct='True')
+
+				# if there's a break, create a new document and structure
+				# FIXME: assumes D/C as the hierarchy
+				brk = brk.strip()
+
+				# a C is an attachment to the last true document
+				if brk == "C" and docnode is not None:
+					attachnode = docnode.find('attachment')
+					if attachnode is None:
+						attachnode = ET.SubElement(docnode, 'attachment')
+					current = ET.SubElement(attachnode, "document",
+					                        {'id':self.ids.next(),
+					                         'parent':docnode.get('id')})
+
+				# anything else starts a new true document
+				elif brk != "" or docnode is None:
+					if docnode is not None: yield self._Fragment(attribs, docnode)
+					docnode = current = ET.Element("document", id=self.ids.next())
+					ET.SubElement(master, "document", id=docnode.get('id'))
+
+				# build the new page element (whole) and add it
+				pgnode = ET.Element("page", {'id':self.ids.next(), 'name':name})
+				pgnode.extend((ET.Element('number', {'type':'bates', 'value':name}),
+				               ET.Element('data', {'path':path.strip(os.path.sep),
+				                                   'filename':filename})))
+				current.append(pgnode)
+
+			# close up processing
+			if docnode is not None: yield self._Fragment(attribs, docnode)
+			if master is not None: yield master
+
+		finally: loadfile.close()
+
+	def Parse(self, line):
+		"""
+		Pull the fields out of one loadfile line (all in one go).
+		Returns:
+			(type, name, break, volume, path, file), or None if the line is bad
+		"""
+		result = self.regex.search(line)
+		if not result: return None
+		return result.group('type', 'name', 'break', 'volume', 'path', 'file')
+
+	def _Fragment(self, attribs, docnode):
+		""" Wrap a finished document in a copy of its source node. """
+		srcnode = ET.Element("source", attribs)
+		srcnode.append(docnode)
+		return srcnode
 
 if __name__ == "__main__":
 	datapath = r"M:\02_07_FM\CityAttorney\AMEC_SALTER_0214\Scan\SALTER001"
@@ -17,7 +17,16 @@ except KeyError:
 	import imp
 	plugin = imp.load_source('plugin', os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'plugin.py')))
 
+def _StatKey(path):
+	""" (size, mtime, inode) of a path, or None if it isn't there. """
+	try: stat = os.stat(path)
+	except OSError: return None
+	return (stat.st_size, stat.st_mtime, stat.st_ino)
+
 class LoadfilePlugin(plugin.Plugin):
+	# the loaders keep their open file on the instance
+	singleinstance = True
+
 	def Init(self, *args, **kwargs):
 		# initialize all of our loadfile members
 		# okay, so doculex isn't a load "file" ... it HAS files, though
@@ -25,7 +34,7 @@ class LoadfilePlugin(plugin.Plugin):
 		self.ipro = IPRO()
 		self.opticon = Opticon()
 
-		# filename validity cache (with some sys.stat output)
+		# filename validity cache (path -> what it looked like when it failed)
 		self.invalid = {}
 		
 		# universal page ordering counter
@@ -42,11 +51,10 @@ class LoadfilePlugin(plugin.Plugin):
 
 		# grab some stats
 		fname = srcnode.get('href')
-		modtime = 0
-		if os.path.exists(fname): modtime = os.stat(fname).st_mtime
+		statkey = _StatKey(fname)
 
 		# save ourselves a bad trip
-		if self.invalid.has_key(fname) and self.invalid[fname] == modtime:
+		if self.invalid.has_key(fname) and self.invalid[fname] == statkey:
 			return False
 
 		# walk the handlers in order of metadata potential
@@ -62,7 +70,7 @@ class LoadfilePlugin(plugin.Plugin):
 			return True
 
 		# cache our response to this silly question
-		self.invalid[srcnode] = modtime
+		self.invalid[fname] = statkey
 
 	def handle(self, level, xjob):
 		""" Run a Loadfile import against a parameter. """
@@ -70,6 +78,19 @@ class LoadfilePlugin(plugin.Plugin):
 		fname = srcnode.attrib['href']
 		type = srcnode.attrib['type']
 
+		# stream what we can: each document goes on as soon as it's read,
+		# followed by a master for AssembleSourcePlugin to rebuild the source
+		# (only a source's first fragment is flagged as a new source)
+		if hasattr(getattr(self, type), 'Iterate'):
+			seen = set()
+			for source in getattr(self, type).Iterate(fname):
+				fragment = ET.Element('xjob', xjob.attrib)
+				fragment.set('newsource', str(source.get('id') not in seen))
+				seen.add(source.get('id'))
+				fragment.append(source)
+				yield fragment
+			return
+
 		# get data
 		loader = getattr(self, type).Read(fname)
 
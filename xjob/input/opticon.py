@@ -6,6 +6,7 @@
 
 import re, glob, os, uuid
 import xml.etree.ElementTree as ET
+from sequence import IdSequence
 
 class Opticon:
 	"""
@@ -34,6 +35,9 @@ class Opticon:
 		# compile regular expression
 		self.regex = re.compile(expression, re.VERBOSE)
 
+		# source/document/page ids
+		self.ids = IdSequence()
+
 	def getvalidname(self, filename):
 		""" See if we can load a given path. """
 		if not os.path.exists(filename): return None
@@ -55,77 +59,97 @@ class Opticon:
 		return None
 
 	def Read(self, filename):
-		# fire up the loadfile in text mode
-		self.loadfile = open(filename, 'r')
-		basepath = os.path.dirname(filename)
+		""" Load the whole loadfile into one xjob tree (self.XML). """
+		self.XML = ET.Element("xjob")
 
-		# build base of tree
-		build = ET.TreeBuilder()
-		root = build.start("xjob",{})
-		volume = build.start("source",{'href':basepath, 'id':str(uuid.uuid4()), 'type':'opticon'})
+		# stitch the streamed documents back under their sources
+		sources = {}
+		for srcnode in self.Iterate(filename):
+			if srcnode.get('reconstruct') is not None: continue
+			if not sources.has_key(srcnode.get('id')):
+				sources[srcnode.get('id')] = ET.SubElement(self.XML, 'source', srcnode.attrib)
+			for docnode in list(srcnode): sources[srcnode.get('id')].append(docnode)
 
-		# kick off tree-depth tracking stack (we need this for back-references)
-		tree = []
-		tree.append(root)
+		return self
+
+	def Iterate(self, filename):
+		"""
+		Read the loadfile a line at a time, generating each document as soon
+		as it's complete, as <source ...><document>...</document></source>.
+		Each source finishes with its master, a <source reconstruct="True">
+		holding an empty <document id="..." /> for every document, in order,
+		for AssembleSourcePlugin to put back together.
+		"""
+		# fire up the loadfile in text mode
+		loadfile = open(filename, 'r')
+		basepath = os.path.dirname(filename)
 
 		# initialize number of lines and errors
-		linenum = 0
-		linerrs = []
-
-		# get hint for readlines
-		self.loadfile.readlines()
-		hint = self.loadfile.tell()
-		self.loadfile.seek(0)
-
-		# read lines from Opticon
-		for line in self.loadfile.readlines(hint):
-			# increment line number
-			linenum+= 1
-
-			# parse line
-			result = self.regex.search(line)
-
-			# complain about result
-			if not result:
-				linerrs.append(linenum, line)
-				continue
-
-			# try to assign the volume one of our values
-			if not volume.attrib.has_key("name"):
-				volume.attrib["name"] = result.group("volume")
-
-			# otherwise see if we should start a new volume
-			elif volume.attrib["name"] != result.group("volume"):
-				build.end("source")
-				volume = build.start("source", {'href':basepath,
-				                                'id':str(uuid.uuid4()),
-				                                'name':result.group('volume'),
-				                                'type':'opticon'})
-
-			# if there's a break, create a new document
-			if result.group("break").strip() == "Y":
-				if tree[-1].tag == "document":
-					build.end("document")
-					tree.pop()
-				tree.append(build.start("document",{'id':str(uuid.uuid4())}))
-
-			# start a new page element
-			pgnode = build.start("page",{'id':str(uuid.uuid4()), 'name':result.group("name")})
-			ET.SubElement(pgnode, 'number', {'type':'bates', 'value':result.group("name")})
-			ET.SubElement(pgnode, 'data', {'path':result.group("path").strip(os.path.sep),
-			                               'filename':result.group("file")})
-			build.end("page")
-
-		# close up processing
-		build.end("document")
-		build.end("source")
-		build.end("xjob")
-
-		# generate xml output
-		self.XML = build.close()
-		self.loadfile.close()
-
-		self.lines = linenum
+		self.lines = 0
+		self.linerrs = []
+
+		# the current source's attributes, its master and the open document
+		attribs = master = docnode = None
+
+		try:
+			# read lines from Opticon
+			for line in loadfile:
+				# increment line number
+				self.lines += 1
+
+				# parse line
+				result = self.Parse(line)
+
+				# complain about result
+				if result is None:
+					self.linerrs.append((self.lines, line))
+					continue
+				name, volume, path, filename, brk = result
+
+				# see if we should start a new volume (and finish the last)
+				if attribs is None or attribs['name'] != volume:
+					if docnode is not None: yield self._Fragment(attribs, docnode)
+					if master is not None: yield master
+					docnode = None
+
+					attribs = {'href':basepath, 'id':self.ids.next(),
+					           'name':volume, 'type':'opticon'}
+					master = ET.Element("source", attribs, reconstruct='True')
+
+				# if there's a break, create a new document
+				if brk == "Y" or docnode is None:
+					if docnode is not None: yield self._Fragment(attribs, docnode)
+					docnode = ET.Element("document", id=self.ids.next())
+					ET.SubElement(master, "document", id=docnode.get('id'))
+
+				# build the new page element (whole) and add it
+				pgnode = ET.Element("page", {'id':self.ids.next(), 'name':name})
+				pgnode.extend((ET.Element('number', {'type':'bates', 'value':name}),
+				               ET.Element('data', {'path':path.strip(os.path.sep),
+				                                   'filename':filename})))
+				docnode.append(pgnode)
+
+			# close up processing
+			if docnode is not None: yield self._Fragment(attribs, docnode)
+			if master is not None: yield master
+
+		finally: loadfile.close()
+
+	def Parse(self, line):
+		"""
+		Pull the fields out of one loadfile line (all in one go).
+		Returns:
+			(name, volume, path, file, break), or None if the line is bad
+		"""
+		result = self.regex.search(line)
+		if not result: return None
+		return result.group('name', 'volume', 'path', 'file', 'break')
+
+	def _Fragment(self, attribs, docnode):
+		""" Wrap a finished document in a copy of its source node. """
+		srcnode = ET.Element("source", attribs)
+		srcnode.append(docnode)
+		return srcnode
 
 if __name__ == "__main__":
 	datapath = r"M:\02_07_FM\CityAttorney\AMEC_SALTER_0214\Scan\SALTER001"
@@ -0,0 +1,22 @@
+# Cheap unique ids for the loadfile readers
+#
+
+import uuid, itertools
+
+class IdSequence:
+	"""
+	Hands out uuid-shaped ids: one random uuid4 prefix for the whole run and
+	a counter for the last group, so a page id costs a string format instead
+	of a trip to os.urandom. Ids are unique as long as the prefix is, and a
+	sequence is safe to share between threads (the counter is atomic).
+	"""
+	def __init__(self):
+		self.prefix = str(uuid.uuid4())[:24]
+		self.counter = itertools.count()
+
+	def __iter__(self):
+		return self
+
+	def next(self):
+		""" Get the next id. """
+		return '%s%012x' % (self.prefix, self.counter.next())
@@ -7,50 +7,79 @@ import time, uuid, threading
 from pipeline import *
 from plugins import *
 from input import *
-from callbackplugin import CallbackOrDie
+from callbackplugin import CallbackOrDie, BufferedDispatcher
 
 class InputPipeline(object):
 	""" An input handling object using the Pipeline system. """
 
-	def __init__(self, settings, manager, callback):
+	def __init__(self, settings, manager, callback, workers=None, processes=None,
+	             highwater=None, hashcache=None, ioengine=None):
 		# define the Settings and SourceManager objects
 		self.sets = settings
 		self.manager = manager
-		self.callback = callback
 
 		# set a kill event for the listener
 		self.killevent = threading.Event()
 
-		# allocate a 30-wide pipeline
-		self.pipeline = Pipeline(30)
+		# stage label -> number of instances to run (defaults to one)
+		# (a stage's label is its plugin's class name, or for a CallbackOrDie,
+		#  its command; class names cover every stage of that class too)
+		self.workers = workers or {}
+
+		# stage label -> size of the process pool to run it in (if any)
+		self.processes = processes or {}
+
+		# a pooled hasher runs in other processes: it makes its own IOEngine
+		# there (ours won't pickle, and its threads don't survive a fork), but
+		# a HashCache can't be shared with it at all
+		self.poolhash = self.__Size(self.processes, HashNSizerPlugin, {}, 0) > 0
+		if self.poolhash and hashcache is not None:
+			raise ValueError("A hash cache can't be used with a pooled HashNSizerPlugin")
+
+		# the OmniHandler, with progress counts added up between updates
+		self.callback = BufferedDispatcher(callback)
+
+		# allocate a 30-wide pipeline (highwater bounds the inner levels)
+		self.pipeline = Pipeline(30, highwater)
+
+		# a digest cache file lets files we've seen before skip hashing
+		self.hashcache = (hashcache is not None and (HashCache(hashcache),) or (None,))[0]
+
+		# page file I/O runs on a shared IOEngine (ours unless we're given one)
+		self.ownio = ioengine is None
+		self.io = (self.ownio and (IOEngine(),) or (ioengine,))[0]
 
 		# set up a loadfile handler to start
-		self.pipeline.AddTask(LoadfilePlugin)
+		self.__AddTask(LoadfilePlugin)
 
 		# attempt to add a named entry to the input list
-		self.pipeline.AddTask(CallbackOrDie,
+		# (once per source: streamed fragments after the first are let by)
+		self.__AddTask(CallbackOrDie,
 		            command='add new source', callback=self.callback,
+		            select=lambda x:x.get('newsource', 'True') == 'True',
 					validate=lambda x:x.find('source').get('name') is not None,
 				    value=lambda x: x.find('source').get('name'))
 	
 		# make sure that the result has document nodes or, if it's not a
 		# reconstruct system, that it has page nodes
 		# then, if it's not a reconstruct, add the number of documents
-		# to the list entry
-		self.pipeline.AddTask(CallbackOrDie,
+		# to the list entry (streamed documents were counted on the way in)
+		self.__AddTask(CallbackOrDie,
 		            command='add source documents', callback=self.callback,
 		            validate=lambda x:x.find('.//document') is not None and \
 		                              (x[0].attrib.has_key('reconstruct') or \
 		                              x.find('.//page') is not None),
-		            value=lambda x:len(x.findall('.//document')))
+		            value=lambda x:(not x[0].attrib.has_key('reconstruct') and \
+		                            len(x.findall('.//document'))) or 0)
 
 		# add a hash and size description to the source/doc/page nodes
-		self.pipeline.AddTask(HashNSizerPlugin)
+		self.__AddTask(HashNSizerPlugin, hashcache=self.hashcache,
+		               ioengine=(not self.poolhash and (self.io,) or (None,))[0])
 
 		# make sure that each page node has a data node and that each data node
 		# has a size attribute 
 		# then add that size to the list entry for the source
-		self.pipeline.AddTask(CallbackOrDie,
+		self.__AddTask(CallbackOrDie,
 		    command='add source size', callback=self.callback,
 		    validate=lambda x:\
 		      0 not in [d.find('data') for d in x.getiterator('page')] and \
@@ -58,7 +87,7 @@ class InputPipeline(object):
 		    value=lambda x:sum([int(d.get('size')) for d in x.getiterator('data')]))
 
 		# put all the document elements together
-		self.pipeline.AddTask(AssembleSourcePlugin)
+		self.__AddTask(AssembleSourcePlugin)
 		
 		# load the result into a source manager and destroy it
 		self.listener = threading.Thread(target=self.__ManagerListener,
@@ -90,6 +119,33 @@ class InputPipeline(object):
 		# put the new xjob to the pipeline
 		self.pipeline.put(xjob)
 
-	def close(self):
-		""" Shut down the pipeline for exit. """
-		self.pipeline.close()
+	def __AddTask(self, plugin, *args, **kwargs):
+		""" Add a stage to the pipeline, sized by our worker counts """
+		kwargs.setdefault('workers', self.__Size(self.workers, plugin, kwargs, 1))
+		kwargs.setdefault('processes', self.__Size(self.processes, plugin, kwargs, 0))
+		self.pipeline.AddTask(plugin, *args, **kwargs)
+
+	def __Size(self, sizes, plugin, kwargs, default):
+		""" Look a stage up by its label, then by its class name. """
+		label = kwargs.get('command', plugin.__name__)
+		return sizes.get(label, sizes.get(plugin.__name__, default))
+
+	def drain(self, timeout=None):
+		""" Wait for everything we've been given to make it through. """
+		return self.pipeline.drain(timeout)
+
+	def shutdown(self, timeout=None):
+		""" Stop the pipeline's threads, returning any that won't quit. """
+		return self.pipeline.shutdown(timeout)
+
+	def close(self, metricsfile=None):
+		""" Shut down the pipeline for exit (optionally dumping metrics). """
+		# stop the listener (a null item wakes it up to notice)
+		self.killevent.set()
+		self.pipeline.output.put(None)
+
+		stragglers = self.pipeline.close(metricsfile)
+		self.callback.close()
+		if self.hashcache is not None: self.hashcache.close()
+		if self.ownio: self.io.close()
+		return stragglers
@@ -44,18 +44,21 @@ class OCRPlugin(plugin.Plugin):
 
 	def canhandle(self, xjob):
 		""" See if a) we can actually run OCR and b) if it needs it. """
-		print "hit ocr handler with havecom:", _HaveCOM, " canOCR:", self.canOCR, " ops/OCR", self.settings['operations/OCR']
-		return _HaveCOM and self.canOCR and self.settings['operations/OCR'] is not None
+		if __debug__:
+			print "hit ocr handler with havecom:", _HaveCOM, " canOCR:", self.canOCR, " ops/OCR", self.settings['operations/OCR']
+		return _HaveCOM and self.canOCR and self.settings['operations/OCR'] is not None \
+		       and xjob.get('complete', None) is None
 
 	def handle(self, level, xjob):
 		""" Run OCR against an xjob. """
 		# see if our settings revision checks out, fetch settings otherwise
-		rev = int(self.settings.getrevision())
+		settings = self.settings.snapshot()
+		rev = int(settings.revision)
 		if self.revision != rev:
 			self.revision = rev
 
 			# grab Rotation preference
-			if self.settings['operations/ProcessOCR'] is not None:
+			if settings['operations/ProcessOCR'] is not None:
 				self.rotate = True
 				self.deskew = True
 			else:
@@ -4,34 +4,67 @@
 
 import xml.etree.ElementTree as ET
 
-import tempfile
+import os, tempfile
 
 from pipeline import *
 from plugins import *
 from ocrplugin import OCRPlugin
 from embedplugin import EmbedPlugin
-from callbackplugin import CallbackOrDie
+from callbackplugin import CallbackOrDie, BufferedDispatcher
 
 class OutputPipeline(object):
 	""" An input handling object using the Pipeline system. """
 
-	def __init__(self, settings, manager, callback):
+	def __init__(self, settings, manager, callback, workers=None, processes=None,
+	             highwater=None, journal=None, transfer='reference', inflight=64<<20,
+	             ioengine=None, tempdir=None):
 		# define the Settings object
 		self.settings = settings
 		self.manager = manager
-		self.callback = callback
 
-		# create a local temporary directory for file storage
-		self.tempdir = tempfile.mkdtemp(prefix="xjob-local-")
+		# the OmniHandler, with progress counts added up between updates
+		self.callback = BufferedDispatcher(callback)
 
-		# allocate a 30-wide pipeline
-		self.pipeline = Pipeline(30)
+		# create a local temporary directory for file storage (unless we're
+		# given one; a journaled run keeps its files beside the journal, so a
+		# restart finds the ones it's skipping)
+		if tempdir is None and journal is not None: tempdir = journal + '.files'
+		if tempdir is None: tempdir = tempfile.mkdtemp(prefix="xjob-local-")
+		elif not os.path.isdir(tempdir): os.makedirs(tempdir)
+		self.tempdir = tempdir
+
+		# stage label -> number of instances to run (defaults to one)
+		# (a stage's label is its plugin's class name, or for a CallbackOrDie,
+		#  its command; class names cover every stage of that class too)
+		self.workers = workers or {}
+
+		# stage label -> size of the process pool to run it in (if any)
+		self.processes = processes or {}
+
+		# a completion journal lets a restarted run skip finished documents
+		self.journal = (journal is not None and (Journal(journal),) or (None,))[0]
+
+		# page file I/O runs on a shared IOEngine (ours unless we're given one)
+		self.ownio = ioengine is None
+		self.io = (self.ownio and (IOEngine(),) or (ioengine,))[0]
+
+		# page data carried in-band is capped at inflight bytes between Soak and
+		# Flush, and kept out of the tree (by data node) while it's in flight
+		self.budget = (transfer == 'data' and (ByteBudget(inflight),) or (None,))[0]
+		self.payloads = (transfer == 'data' and (PayloadTable(),) or (None,))[0]
+
+		# allocate a 30-wide pipeline (highwater bounds the inner levels)
+		self.pipeline = Pipeline(30, highwater)
 
 		# process the bulk by document
-		self.pipeline.AddTask(ProcessByDocumentPlugin)
+		self.__AddTask(ProcessByDocumentPlugin)
+
+		# pick up the documents a previous run already finished
+		if self.journal is not None:
+			self.__AddTask(ResumePlugin, journal=self.journal, settings=self.settings)
 
 		# callback to flag completion of output
-		self.pipeline.AddTask(CallbackOrDie,
+		self.__AddTask(CallbackOrDie,
 		            callback=self.callback, command='add destination documents',
 		            validate=lambda x:x.find('.//document') is not None and \
 		                              (not x[0].attrib.has_key('reconstruct') or \
@@ -39,40 +72,47 @@ class OutputPipeline(object):
 		            value=lambda x:len(x.findall('.//document')))
 
 		# write numbering for each document
-		self.pipeline.AddTask(RenderNumbering, settings=self.settings)
+		self.__AddTask(RenderNumbering, settings=self.settings, manager=self.manager)
 
-		# pull the data from its location
-		self.pipeline.AddTask(SoakPlugin)
+		# pull the data from its location (by default Flush is local, so it can
+		# copy the files itself rather than have them carried through the pipeline)
+		self.__AddTask(SoakPlugin, transfer=transfer, budget=self.budget,
+		               payloads=self.payloads, ioengine=self.io)
 
 		# write the data to a temporary location
-		self.pipeline.AddTask(FlushPlugin, tempdir=self.tempdir)
+		self.__AddTask(FlushPlugin, tempdir=self.tempdir, payloads=self.payloads,
+		               ioengine=self.io)
 
 		# add a hash and size description to the source/doc/page nodes
-		self.pipeline.AddTask(OCRPlugin, settings=self.settings)
+		self.__AddTask(OCRPlugin, settings=self.settings)
 
 		# add a hash and size description to the source/doc/page nodes
-		self.pipeline.AddTask(EmbedPlugin, settings=self.settings)
+		self.__AddTask(EmbedPlugin, settings=self.settings)
+
+		# write down each finished document (and its files' checksums)
+		if self.journal is not None:
+			self.__AddTask(CheckpointPlugin, journal=self.journal, settings=self.settings)
 
 		# callback to flag completion of output
-		self.pipeline.AddTask(CallbackOrDie, callback=self.callback,
+		self.__AddTask(CallbackOrDie, callback=self.callback,
 		            command='add complete destination documents',
 		            validate=lambda x:x.find('.//document') is not None,
 		            value=lambda x:len(x.findall('.//document')))
 
 		# put all the document elements together
-		self.pipeline.AddTask(AssembleSourcePlugin)
+		self.__AddTask(AssembleSourcePlugin)
 
 		# define boundaries for volume rendering
-		self.pipeline.AddTask(RenderVolume, settings=self.settings)
+		self.__AddTask(RenderVolume, settings=self.settings)
 
 		# change the directory structure for each volume
-		self.pipeline.AddTask(RenderDirectory, settings=self.settings)
+		self.__AddTask(RenderDirectory, settings=self.settings, manager=self.manager)
 
 		# write the compatibility layer (loadfiles for each volume)
-		#self.pipeline.AddTask(OutputLoadfiles, settings=self.settings)
+		#self.__AddTask(OutputLoadfiles, settings=self.settings)
 
 		# attempt to add a named entry to the input list
-		self.pipeline.AddTask(CallbackOrDie,
+		self.__AddTask(CallbackOrDie,
 		    callback=self.callback, command='add new destination',
 		    validate=lambda x:x.find('destination').get('name') is not None,
 		    value=lambda x: x.find('destination').get('name'))
@@ -82,10 +122,20 @@ class OutputPipeline(object):
 		# get the ordered set of xjobs to render
 		basexjob = self.manager.GetOrderedXJOB()
 
+		# numbering goes by the job's first page (its number, or else its
+		# name), not by whichever document happens to get numbered first
+		attrib = basexjob.attrib.copy()
+		firstpage = next(basexjob.iter('page'), None)
+		if firstpage is not None:
+			firstnum = firstpage.find('number')
+			attrib['firstnumber'] = (firstnum is not None and
+			                         (firstnum.get('value'),) or
+			                         (firstpage.get('name'),))[0]
+
 		# for each source underneath it
 		for source in basexjob:
 			# make a facsimile xjob
-			xjob = ET.Element('xjob', basexjob.attrib)
+			xjob = ET.Element('xjob', attrib)
 
 			# append the given sort-order source
 			xjob.append(source)
@@ -93,6 +143,32 @@ class OutputPipeline(object):
 			# push the new node
 			self.pipeline.put(xjob)
 
-	def close(self):
-		""" Shut down the pipeline for exit. """
-		self.pipeline.close()
+	def __AddTask(self, plugin, *args, **kwargs):
+		""" Add a stage to the pipeline, sized by our worker counts """
+		kwargs.setdefault('workers', self.__Size(self.workers, plugin, kwargs, 1))
+		kwargs.setdefault('processes', self.__Size(self.processes, plugin, kwargs, 0))
+		self.pipeline.AddTask(plugin, *args, **kwargs)
+
+	def __Size(self, sizes, plugin, kwargs, default):
+		""" Look a stage up by its label, then by its class name. """
+		label = kwargs.get('command', plugin.__name__)
+		return sizes.get(label, sizes.get(plugin.__name__, default))
+
+	def drain(self, timeout=None):
+		""" Wait for everything we've been given to make it through. """
+		return self.pipeline.drain(timeout)
+
+	def shutdown(self, timeout=None):
+		""" Stop the pipeline's threads, returning any that won't quit. """
+		return self.pipeline.shutdown(timeout)
+
+	def close(self, metricsfile=None):
+		""" Shut down the pipeline for exit (optionally dumping metrics). """
+		# (the stages are stopped first, and any that won't stop find the
+		# journal closed rather than writing into it as it goes)
+		stragglers = self.pipeline.close(metricsfile)
+		self.callback.close()
+		if self.journal is not None: self.journal.close()
+		if self.payloads is not None: self.payloads.close()
+		if self.ownio: self.io.close()
+		return stragglers
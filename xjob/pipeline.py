@@ -3,10 +3,52 @@
 #
 
 import sys, time, os
-import threading, Queue
+import threading, Queue, json
 
 from plugin import *
 
+class LevelQueue(Queue.Queue):
+	"""
+	The inbound queue for one Pipeline level, with a high-water mark.
+	Producers reserve() a spot before sending an item toward the level,
+	and the spot is freed when the level takes the item off the queue.
+	The put itself never blocks, so the Recycler can't wedge on a full level.
+	"""
+	def __init__(self, highwater=0):
+		Queue.Queue.__init__(self)
+		self.highwater = highwater
+		self.pending = 0
+		self.room = threading.Condition(threading.Lock())
+
+	def reserve(self):
+		""" Block until the level is under its high-water mark, then hold a spot. """
+		self.room.acquire()
+		try:
+			while self.highwater and self.pending >= self.highwater:
+				self.room.wait()
+			self.pending += 1
+		finally: self.room.release()
+
+	def open(self):
+		""" Drop the high-water mark and wake everyone waiting on it. """
+		self.room.acquire()
+		self.highwater = 0
+		self.room.notifyAll()
+		self.room.release()
+
+	def get(self, block=True, timeout=None):
+		""" Take an item off the queue and give its spot back. """
+		item = Queue.Queue.get(self, block, timeout)
+
+		# dead events never reserved a spot
+		if item[1] is not None:
+			self.room.acquire()
+			self.pending -= 1
+			self.room.notify()
+			self.room.release()
+
+		return item
+
 class Pipeline(object):
 	"""
 	A data rendering pipeline, generalized for modules.
@@ -18,41 +60,66 @@ class Pipeline(object):
 
 	A simple module will act like this:
 		while not self.quitevent.isSet():
-			sleep(1) # needs to yield
 			(signature, item) = self.queue.get(1)
-			if not self.handles(signature):
-				self.queue.put((signature, item))
+			if not self.canhandle(item):
+				self.outqueue.put((signature, item))
+				continue
 			print signature,':',item
 			self.process(item)
-			self.outqueue.put((signature+1, item))
+			self.outqueue.put((signature, item))
 
 	So, signatures are basically an elevator.
-		If a signature is not handled at a certain elevator level,
-		the signature is incremented until it falls off the edge of the earth.
-		(Or, at least, until the signature hits a level that is handled.)
+		Every level has its own inbound queue, and only that level's
+		threads wait on it.  Results go to the middle queue, where the
+		Recycler looks up the next level and delivers them straight to it,
+		until the signature falls off the edge of the earth.
+		(Or, at least, until it hits the output queue.)
 
 	Registering with the pipeline is as simple as this:
 		pipeline.AddItem(module)
+
+	Every level's queue has a high-water mark (length for the first level,
+	highwater for the rest, 0 for none); anything headed for a full level
+	waits until it drains.  See occupancy() for the current state.
+
+	Each level keeps counters (see StageMetrics) for throughput, time in
+	canhandle/handle and time spent waiting on queues; read them live with
+	metrics(), or have close() dump them to a JSON file.
+
+	To finish a run cleanly, drain() until everything has reached the output,
+	then shutdown() to stop the threads (close() just throws work away).
 	"""
-	def __init__(self, length=10):
+	def __init__(self, length=10, highwater=None):
 		self.masterquit = threading.Event()
-		self.pipeline = Queue.Queue(length)
 		self.middle = Queue.Queue()
 		self.output = Queue.Queue()
 
+		# the entry level's queue is bounded by length, the rest by highwater
+		self.length = length
+		self.highwater = (highwater is None and (length,) or (highwater,))[0]
+
 		# make sure that we don't stop before we start
 		self.masterquit.clear()
 
+		# level -> StageMetrics (shared by a level's workers)
+		self.stagemetrics = {}
+		self.started = timer()
+
+		# one inbound queue per level (pushback owns the last one)
+		self.queues = {sys.maxint: LevelQueue(self.highwater)}
+
 		# initialize tasks, tack pushback to end
-		self.tasklist = [(sys.maxint, PushBackPlugin(sys.maxint, self.pipeline,
-		                  self.middle, self.output, self.masterquit))]
+		self.tasklist = [(sys.maxint, PushBackPlugin(sys.maxint,
+		                  self.queues[sys.maxint], self.middle, self.output,
+		                  self.masterquit))]
 
 		# set up Recycler (elevates based on the task list)
-		self.recycler = RecyclerPlugin(self.pipeline, self.middle,
+		self.recycler = RecyclerPlugin(self.queues, self.middle,
 		                               [x[0] for x in self.tasklist],
 		                               self.masterquit)
 
 		# boot up the master threads
+		self.stagemetrics[sys.maxint] = self.tasklist[0][1].metrics
 		self.tasklist[0][1].setDaemon(True)
 		self.tasklist[0][1].start()
 		self.recycler.setDaemon(True)
@@ -63,56 +130,189 @@ class Pipeline(object):
 		Append a task to the pipeline task list.
 		>>> pl = Pipeline()
 		>>> pl.AddTask(xjob.tasks.CopyToTempFiles)
-		>>> pl.AddTask(xjob.tasks.Embed)
+		>>> pl.AddTask(xjob.tasks.Embed, workers=4)
 		>>> pl.AddTask(xjob.tasks.OCR)
 		>>> for doc in docs: pl.put(doc)
 		>>> while not pl.empty():
 		...     out_docs.append(pl.get())
+
+		The workers keyword runs that many instances of the plugin against
+		the same level, unless the plugin is flagged as a singleinstance.
+		The processes keyword runs the plugin in a pool of that many
+		processes instead (for CPU-bound stages), fed by a single thread.
+		The batch keyword overrides how many queued items each instance takes
+		per wakeup (the plugin's batchsize; see Plugin.handle_batch).
 		"""
-		# add the plugin and sort the list
-		newkey = len(self.tasklist)-1
-		self.tasklist.insert(newkey, (newkey, plugin(newkey, self.pipeline, self.middle, self.masterquit, *args, **kwargs)))
+		# see how many instances we're running on this level
+		workers = int(kwargs.pop('workers', 1))
+		processes = int(kwargs.pop('processes', 0))
+		batch = int(kwargs.pop('batch', plugin.batchsize))
+		if workers < 1 or processes < 0:
+			raise ValueError("Tasks need at least one worker")
+		if batch < 1:
+			raise ValueError("Tasks need a batch size of at least one")
+		if max(workers, processes) > 1 and plugin.singleinstance:
+			raise ValueError(plugin.__name__ + " can only run as a single instance")
+		if workers > 1 and processes:
+			raise ValueError("Tasks run either in workers or in processes")
+
+		# add the level (pushback keeps the last one)
+		newkey = len(self.queues)-1
+
+		# give the new level its own queue and counters
+		self.queues[newkey] = LevelQueue(not newkey and self.length or self.highwater)
+		self.stagemetrics[newkey] = StageMetrics(newkey, plugin.__name__)
+
+		for i in xrange(workers):
+			# every worker shares the level's queue
+			if processes:
+				task = PoolPlugin(newkey, self.queues[newkey], self.recycler,
+				                  self.masterquit, plugin, processes,
+				                  *args, **kwargs)
+			else:
+				task = plugin(newkey, self.queues[newkey], self.recycler,
+				              self.masterquit, *args, **kwargs)
 
-		# run the plugin (it will always be at the second-to-last position)
-		self.tasklist[-2][1].setDaemon(True)
-		try:self.tasklist[-2][1].setName(str(newkey)+'-'+plugin.__name__)
-		finally:self.tasklist[-2][1].start()
-		self.recycler.setLevels([x[0] for x in self.tasklist])
+			# run the plugin (it will always be before the pushback)
+			task.metrics = self.stagemetrics[newkey]
+			task.batchsize = batch
+			self.tasklist.insert(len(self.tasklist)-1, (newkey, task))
+			task.setDaemon(True)
+			try:task.setName(str(newkey)+'-'+plugin.__name__+(workers > 1 and '-'+str(i) or '')+(processes and '-pool' or ''))
+			finally:task.start()
+
+		self.recycler.setLevels(self.queues.keys())
 
 	def empty(self):
-		""" A shortcut to the three-way boolean state of our child queues. """
-		return self.pipeline.empty() and self.middle.empty() and self.output.empty()
+		""" A shortcut to the boolean state of our child queues. """
+		return self.middle.empty() and self.output.empty() and \
+		       not [q for q in self.queues.itervalues() if not q.empty()]
 
 	def put(self, item):
-		""" This method inserts a new value into the pipeline queue. """
-		self.pipeline.put((0, item), block=True)
+		""" This method inserts a new value into the first level's queue. """
+		level = min(self.queues)
+		self.queues[level].reserve()
+		self.queues[level].put((level, item), block=True)
+
+	def occupancy(self):
+		"""
+		Get the current state of each level's queue.
+		Returns:
+			{level: (items queued, items queued or on the way, high-water mark)}
+		"""
+		return dict((level, (queue.qsize(), queue.pending, queue.highwater))
+		            for level, queue in self.queues.items())
+
+	def metrics(self):
+		"""
+		Get a live snapshot of every level's counters and queue state.
+		Returns:
+			{'elapsed': seconds since the pipeline started,
+			 'levels': {level: {counter: value, ..., 'queued': n, 'pending': n}}}
+		"""
+		levels = {}
+		for level, (queued, pending, highwater) in self.occupancy().items():
+			levels[level] = self.stagemetrics[level].snapshot()
+			levels[level].update(queued=queued, pending=pending, highwater=highwater)
+
+		return {'elapsed': timer() - self.started, 'levels': levels}
 
 	def get(self, timeout=None):
 		""" Blocking get on self.output with a timeout parameter. """
 		if timeout is not None: return self.output.get(True, timeout)
 		else: return self.output.get(True)
 
-	def close(self):
-		""" Destroys all pipeline plugins, aborts processing and returns. """
+	def drain(self, timeout=None):
+		"""
+		Wait until every item put into the pipeline has made it to the output
+		queue (or been swallowed by a stage, like the Assemble plugins do).
+		Returns False if the timeout (in seconds) ran out first.
+		"""
+		deadline = (timeout is not None and (timer() + timeout,) or (None,))[0]
+
+		# items only ever move up, so once a level and the middle queue behind
+		# it are finished, nothing new can show up on that level again
+		for level in sorted(self.queues):
+			for queue in (self.queues[level], self.middle):
+				if not self.__Join(queue, deadline): return False
+
+		return True
+
+	def __Join(self, queue, deadline):
+		""" Queue.join, with a deadline.  Returns False if we ran out of time. """
+		queue.all_tasks_done.acquire()
+		try:
+			while queue.unfinished_tasks:
+				if deadline is None:
+					queue.all_tasks_done.wait()
+					continue
+
+				remaining = deadline - timer()
+				if remaining <= 0: return False
+				queue.all_tasks_done.wait(remaining)
+		finally: queue.all_tasks_done.release()
+
+		return True
+
+	def shutdown(self, timeout=None):
+		"""
+		Stop every plugin and the Recycler and wait for their threads to end,
+		which runs each plugin's on_end().  Threads finish the item they have,
+		but anything still queued stays put -- drain() first for a clean finish.
+		Returns the names of the threads still running after timeout seconds,
+		and of any that died along the way.
+		"""
+		deadline = (timeout is not None and (timer() + timeout,) or (None,))[0]
 		self.masterquit.set()
 
-		# wake up the Recycler and all the tasks
-		if not self.middle.full(): self.middle.put_nowait((0, None))
-		for i in xrange(len(self.tasklist)):
-			if not self.pipeline.full():
-				self.pipeline.put_nowait((0, None))
+		# let anyone waiting on a full level through
+		for queue in self.queues.itervalues(): queue.open()
+
+		# wake up the Recycler and all the tasks (one dead event per thread)
+		self.middle.put((0, None))
+		for level, task in self.tasklist:
+			self.queues[level].put((level, None))
 
-		# wait a bit
-		time.sleep(0)
+		# wait on each thread in turn and collect the ones that won't quit
+		stragglers = []
+		for thread in [task for level, task in self.tasklist] + [self.recycler]:
+			if deadline is None: thread.join()
+			else: thread.join(max(deadline - timer(), 0))
+			if thread.isAlive() or getattr(thread, 'failure', None) is not None:
+				stragglers.append(thread.getName())
 
-		# drain all pipeline and middle tasks
-		while not self.middle.empty(): self.middle.get_nowait()
-		while not self.pipeline.empty(): self.pipeline.get_nowait()
+		return stragglers
+
+	def close(self, metricsfile=None, timeout=1.0):
+		"""
+		Destroys all pipeline plugins, aborts processing and returns.
+		If metricsfile is given, the final metrics() are written there as JSON.
+		Returns the names of any threads that didn't stop (see shutdown).
+		"""
+		if metricsfile is not None:
+			dump = open(metricsfile, 'w')
+			try: json.dump(self.metrics(), dump, indent=1, sort_keys=True)
+			finally: dump.close()
+
+		self.masterquit.set()
+
+		# throw away all level and middle tasks
+		for queue in self.queues.values() + [self.middle]:
+			while not queue.empty():
+				queue.get_nowait()
+				queue.task_done()
+
+		# stop the threads and complain about the stubborn ones
+		stragglers = self.shutdown(timeout)
+		if stragglers:
+			print >>sys.stderr, "Pipeline threads still running:", ', '.join(stragglers)
 
 		# delete all the queues
-		del(self.pipeline)
+		del(self.queues)
 		del(self.middle)
 		del(self.output)
 
 		# delete all pipeline tasks
 		del(self.tasklist)
+
+		return stragglers
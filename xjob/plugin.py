@@ -2,11 +2,57 @@
 # Eric Ritezel -- February 22, 2007
 #
 
-import threading
-import time
+import sys, threading, traceback, multiprocessing, Queue
+import xml.etree.ElementTree as ET
+from timeit import default_timer as timer
+
+class StageMetrics(object):
+	"""
+	Running counters for one Pipeline level (shared by all of its workers).
+		itemsin/itemsout -- items taken off the queue / results sent on
+		passed -- items skipped forward because canhandle said no
+		failed -- items dropped because canhandle or handle raised
+		canhandletime/handletime -- seconds spent in canhandle/handle
+		waittime -- seconds spent waiting on an empty queue for work
+		puttime -- seconds spent waiting on the next level for room
+		maxdepth -- the deepest the level's queue has been seen
+	"""
+	counters = ('itemsin', 'itemsout', 'passed', 'failed', 'canhandletime',
+	            'handletime', 'waittime', 'puttime')
+
+	def __init__(self, level, name):
+		self.level = level
+		self.name = name
+		self.maxdepth = 0
+		self.lock = threading.Lock()
+		for counter in self.counters: setattr(self, counter, 0)
+
+	def add(self, depth=0, **counts):
+		""" Add to the given counters in one go. """
+		self.lock.acquire()
+		try:
+			for counter, value in counts.iteritems():
+				setattr(self, counter, getattr(self, counter) + value)
+			self.maxdepth = max(self.maxdepth, depth)
+		finally: self.lock.release()
+
+	def snapshot(self):
+		""" Get a consistent dict copy of the counters. """
+		self.lock.acquire()
+		try:
+			result = dict((c, getattr(self, c)) for c in self.counters)
+			result.update(name=self.name, maxdepth=self.maxdepth)
+		finally: self.lock.release()
+		return result
 
 class Plugin(threading.Thread):
 	""" A template for a pipeline processing stage. """
+	# stages that keep ordering state between items can't be run in parallel
+	singleinstance = False
+
+	# the most items to take off the queue per wakeup (see handle_batch)
+	batchsize = 1
+
 	def __init__(self, level, itemq, outq, event, *args, **kwargs):
 		threading.Thread.__init__(self)
 		self.level = level
@@ -14,40 +60,119 @@ class Plugin(threading.Thread):
 		self.outputq = outq
 		self.quitevent = event
 
-		# seems to work pretty well. huh.  maybe it's just this system
-		self.sleeplength = 0.0125+(self.level*0.0001)
+		# the traceback that killed this thread, if one did
+		self.failure = None
+
+		# the Pipeline swaps in a level-wide instance for worker pools
+		self.metrics = StageMetrics(level, self.__class__.__name__)
 
 		# put our own custom init stuff here
 		self.Init(*args, **kwargs)
 
 	def run(self):
+		# run a function on exit (even if the loop itself blows up, which
+		# is noted in failure for shutdown() to report)
+		try: self.Loop()
+		except:
+			self.failure = traceback.format_exc()
+			print >>sys.stderr, self.getName(), "died\n", self.failure
+		finally: self.on_end()
+
+	def Loop(self):
+		"""
+		Take items off our level's queue and handle them until we die,
+		up to batchsize of whatever's already queued at a time.
+		"""
 		# while we're not on the way out (duh)
 		while not self.quitevent.isSet():
-			time.sleep(self.sleeplength)
+			# block on our own level's queue (only our work shows up here)
+			started = timer()
+			batch = [self.inputq.get(block=True)]
+			waited = timer() - started
 
-			# get an item from the queue and deny everyone else
-			incoming = self.inputq.get(block=True)
+			# and take whatever else is waiting, without waiting for more
+			# (but only up to one dead event -- the others are other threads')
+			try:
+				while len(batch) < self.batchsize and batch[-1][1] is not None:
+					batch.append(self.inputq.get(block=False))
+			except Queue.Empty: pass
 
-			# priority mismatch means we need to put this back to input
-			if str(self.level) != str(incoming[0]):
-				self.inputq.put(incoming, block=True)
-				continue
+			# see if we just got dead events (so we can clean up the queue)
+			dead = len([incoming for incoming in batch if incoming[1] is None])
+			batch = [incoming for incoming in batch if incoming[1] is not None]
+			for i in xrange(dead): self.inputq.task_done()
+			if not batch: continue
 
-			# see if we just got a dead event (so we can clean up the queue)
-			if incoming[1] == None: continue
+			try:
+				# see if we have handling capability (an item canhandle blows
+				# up on is reported and dropped)
+				started = timer()
+				handled, skipped = [], []
+				for incoming in batch:
+					try: take = self.canhandle(incoming[1])
+					except Exception:
+						self.__Failed([incoming[1]])
+						continue
+					(take and (handled,) or (skipped,))[0].append(incoming)
+				checked = timer() - started
 
-			# see if we have a priority match and handling capability
-			if self.canhandle(incoming[1]):
-				for output in self.handle(incoming[0], incoming[1]):
-					self.outputq.put((incoming[0], output), block=True)
+				# skip the rest forward
+				started = timer()
+				for incoming in skipped: self.outputq.put(incoming, block=True)
+				skipping = timer() - started
+				outputs = len(skipped)
 
-			# skip this data forward
-			else:self.outputq.put(incoming, block=True)
+				# (handling time is what's left once the puts are taken out)
+				putting = 0.0
+				started = timer()
 
-			self.inputq.task_done()
+				# (a level's queue only ever holds that level's items)
+				if handled:
+					for output in self.__Handle(handled[0][0], [incoming[1] for incoming in handled]):
+						# null results are swallowed here instead of in the Recycler
+						if output is not None:
+							putstart = timer()
+							self.outputq.put((handled[0][0], output), block=True)
+							putting += timer() - putstart
+							outputs += 1
+
+				self.metrics.add(itemsin=len(batch), itemsout=outputs, passed=len(skipped),
+				                 canhandletime=checked, waittime=waited,
+				                 handletime=handled and timer()-started-putting or 0,
+				                 puttime=skipping+putting, depth=self.inputq.qsize())
+
+			# however it went, drain() has to hear that the batch is done with
+			finally:
+				for incoming in batch: self.inputq.task_done()
+
+	def __Handle(self, level, items):
+		"""
+		Run handle_batch on items.  If it blows up before it's given anything
+		back, the items are tried again one at a time, so a bad item only
+		takes itself down; failures are reported and counted, not raised.
+		"""
+		produced = False
+		try:
+			for output in self.handle_batch(level, items):
+				produced = True
+				yield output
+			return
+		except Exception:
+			# (there's no telling which items a half-finished batch got through)
+			if produced or len(items) == 1:
+				self.__Failed(items)
+				return
+
+		for item in items:
+			for output in self.__Handle(level, [item]): yield output
+
+	def __Failed(self, items):
+		""" Report the items the current exception took down, and count them. """
+		print >>sys.stderr, self.getName(), "failed on", \
+		      [hasattr(item, 'get') and item.get('id') or item for item in items], \
+		      "\n", traceback.format_exc()
+		self.metrics.add(failed=len(items))
 
-		# run a function on exit
-		self.on_end()
 
 	def canhandle(self, arg):
 		""" A test to see if this module can handle the data given to it. """
@@ -57,9 +182,129 @@ class Plugin(threading.Thread):
 		""" A generator that runs a transform on a given data object. """
 		yield arg
 
+	def handle_batch(self, level, args):
+		"""
+		A generator that runs a transform on several data objects at once
+		(the ones canhandle took, from one wakeup).  Defaults to handle().
+		"""
+		for arg in args:
+			for output in self.handle(level, arg): yield output
+
 	def on_end(self): pass
 	def Init(self, *args, **kwargs): pass
 
+# the plugin instance living in a pool process (see PoolPlugin)
+_poolplugin = None
+
+def _PoolInit(plugin, level, args, kwargs):
+	""" Build this pool process' own instance of the plugin. """
+	global _poolplugin
+	_poolplugin = plugin(level, None, None, threading.Event(), *args, **kwargs)
+
+def _PoolHandle(level, fragment):
+	"""
+	Run the pool process' plugin against a serialized xjob.
+	Returns (True, None) if the plugin won't take the item, (True, [results])
+	with each result serialized, or (False, traceback) if it blew up.
+	"""
+	try:
+		xjob = ET.fromstring(fragment)
+		if not _poolplugin.canhandle(xjob): return (True, None)
+		return (True, [ET.tostring(output) for output in
+		               _poolplugin.handle(level, xjob) if output is not None])
+	except: return (False, traceback.format_exc())
+
+class PoolPlugin(Plugin):
+	"""
+	Runs another plugin's canhandle/handle in a multiprocessing pool.
+	Items cross the process boundary as serialized xjob fragments, so the
+	wrapped plugin should work from file references, not in-memory data.
+	Plugin arguments are pickled once, when the pool starts, so the pool is
+	started over whenever the settings argument's revision changes.
+	"""
+	def __init__(self, level, itemq, outq, event, plugin, processes, *args, **kwargs):
+		Plugin.__init__(self, level, itemq, outq, event)
+		self.plugin = plugin
+		self.processes = processes
+		self.args = args
+		self.kwargs = kwargs
+
+		# the settings the pool's copies were made from (if the plugin has any)
+		self.settings = kwargs.get('settings')
+		self.pool = self.__Pool()
+
+		# pools that were replaced, finishing what they had
+		self.retired = []
+
+		# keep a couple of fragments waiting on each process
+		self.slots = threading.Semaphore(processes * 2)
+
+	def __Pool(self):
+		""" Start a pool with the current arguments (and note the revision). """
+		self.revision = (self.settings is not None and
+		                 (self.settings.getrevision(),) or (None,))[0]
+		return multiprocessing.Pool(self.processes, _PoolInit,
+		                            (self.plugin, self.level, self.args, self.kwargs))
+
+	def Loop(self):
+		""" Farm items out to the pool until we die. """
+		while not self.quitevent.isSet():
+			started = timer()
+			incoming = self.inputq.get(block=True)
+			waited = timer() - started
+
+			# see if we just got a dead event (so we can clean up the queue)
+			if incoming[1] is None:
+				self.inputq.task_done()
+				continue
+
+			# the pool's settings are stale, so let it finish and start another
+			if self.settings is not None and self.settings.getrevision() != self.revision:
+				self.pool.close()
+				self.retired.append(self.pool)
+				self.pool = self.__Pool()
+
+			# wait for room in the pool and throw the fragment at it
+			self.slots.acquire()
+			self.metrics.add(itemsin=1, waittime=waited, depth=self.inputq.qsize())
+			self.pool.apply_async(_PoolHandle,
+			                      (incoming[0], ET.tostring(incoming[1])),
+			                      callback=self.__Deliver(incoming, timer()))
+
+	def __Deliver(self, incoming, sent):
+		""" Build the pool callback that pushes results for one item. """
+		def deliver(result):
+			# the round trip through the pool counts as handling time
+			started = timer()
+			try:
+				handled, outputs = result
+
+				# the item is lost, but at least tell someone
+				if not handled:
+					print >>sys.stderr, self.getName(), "failed on", \
+					      incoming[1].get('id'), "\n", outputs
+					self.metrics.add(failed=1)
+
+				# skip this data forward
+				elif outputs is None:
+					self.outputq.put(incoming, block=True)
+					self.metrics.add(itemsout=1, passed=1)
+
+				else:
+					for output in outputs:
+						self.outputq.put((incoming[0], ET.fromstring(output)), block=True)
+					self.metrics.add(itemsout=len(outputs))
+			finally:
+				self.metrics.add(handletime=started-sent, puttime=timer()-started)
+				self.slots.release()
+				self.inputq.task_done()
+		return deliver
+
+	def on_end(self):
+		""" Let the pools finish what they have and shut them down. """
+		self.pool.close()
+		for pool in self.retired + [self.pool]: pool.join()
+
 class PushBackPlugin(Plugin):
 	""" Added automatically to the end of the pipeline. """
 	def __init__(self, level, itemq, outq, masteroutput, event):
@@ -69,16 +314,14 @@ class PushBackPlugin(Plugin):
 	def run(self):
 		""" dummy run """
 		while not self.quitevent.isSet():
-			time.sleep(0.01)
-
-			# get an item from the queue and deny everyone else
+			# get an item from the queue (everything here is ours)
 			incoming = self.inputq.get(block=True)
 
-			# see if we have a priority match and handling capability
-			if self.level == incoming[0]:
+			# see if we just got a dead event (so we can clean up the queue)
+			if incoming[1] is not None:
 				self.handle(incoming[0], incoming[1])
-				self.inputq.task_done()
-			else: self.inputq.put(incoming, block=True)
+				self.metrics.add(itemsin=1, itemsout=1, depth=self.inputq.qsize())
+			self.inputq.task_done()
 
 	def handle(self, level, arg):
 		""" Push the argument to the master output queue. """
@@ -87,54 +330,58 @@ class PushBackPlugin(Plugin):
 		return None
 
 class RecyclerPlugin(threading.Thread):
-	""" Runs against the middle and input queues as an elevator. """
-	def __init__(self, inputq, middleq, levels, event):
+	"""
+	Runs against the middle queue as an elevator to each level's queue.
+	Plugins put their results to the Recycler, which holds them up until
+	there's room on the next level (so fan-out stages block when it's full).
+	"""
+	def __init__(self, queues, middleq, levels, event):
 		threading.Thread.__init__(self)
-		self.inputq = inputq
+		self.queues = queues
 		self.middleq = middleq
 		self.quitevent = event
-		self.levels = levels
 		self.level_lock = threading.Lock()
+		self.setLevels(levels)
 
 	def setLevels(self, newlevels):
 		""" Set the levels for the Recycler to walk by. """
+		# sort the levels (don't trust nobody)
+		levels = sorted(newlevels)
+
+		# map each level to the one above it (the last one maps to itself)
+		nextlevels = dict(zip(levels, levels[1:] + levels[-1:]))
+
 		self.level_lock.acquire(True)
-		self.levels = newlevels
+		self.levels = levels
+		self.nextlevels = nextlevels
 		self.level_lock.release()
 
+	def put(self, item, block=True):
+		"""
+		Queue up a (level, item) result for the next level.
+		This blocks until the next level is under its high-water mark.
+		"""
+		# look for the next level up from the incoming object
+		# default to the end of the list (output)
+		self.level_lock.acquire(True)
+		try: newlevel = self.nextlevels.get(item[0], self.levels[-1])
+		finally: self.level_lock.release()
+
+		# hold a spot on that level and send the item on its way
+		self.queues[newlevel].reserve()
+		self.middleq.put((newlevel, item[1]), block)
+
 	def run(self):
 		"""
 			Keep pulling tuples from the middle queue (until we die).
-			Modify the processing level by walking it up the level list.
+			Deliver each one straight to the inbound queue of its level.
 		"""
 		while not self.quitevent.isSet():
-			time.sleep(0.01)
-
 			# grab something from the middle queue
 			incoming = self.middleq.get(block=True)
 
-			# see if we just got a dead event (so we can clean up the queue)
-			if incoming[1] == None: continue
-
-			# lock and look up level in levels
-			self.level_lock.acquire(True)
-
-			# sort the levels (don't trust nobody)
-			self.levels.sort()
-
-			# look for the priority level of the incoming object
-			# default to the end of the list (output)
-			newlevel = self.levels[-1]
-			for i in xrange(len(self.levels)):
-				if self.levels[i] == incoming[0]:
-					if i + 1 == len(self.levels):
-						newlevel = self.levels[-1]
-					else:
-						newlevel = self.levels[i+1]
-					break
-
-			# release the lock on levels
-			self.level_lock.release()
-
-			# put the level onto the input queue
-			self.inputq.put((newlevel, incoming[1]), block=True)
+			# put the item onto its level's own queue (room is reserved)
+			if incoming[1] is not None:
+				self.queues[incoming[0]].put(incoming, block=True)
+
+			self.middleq.task_done()
@@ -3,9 +3,13 @@
 #
 
 import deps
+from deps.hashcache import HashCache
+from deps.spool import ByteBudget, Payload, PayloadTable
+from deps.ioengine import IOEngine
 from assembleplugin import AssembleSourcePlugin, AssembleDocumentPlugin
 from processplugin import ProcessByDocumentPlugin, ProcessByPagePlugin
 from render import RenderDirectory, RenderNumbering, RenderVolume
 from util import TimerPlugin, XJOBWriterPlugin
 from soakplugin import SoakPlugin, FlushPlugin
 from hashplugin import HashNSizerPlugin
+from journal import Journal, ResumePlugin, CheckpointPlugin
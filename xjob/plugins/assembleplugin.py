@@ -12,12 +12,31 @@ except KeyError:
 	plugin = imp.load_source('plugin', os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'plugin.py')))
 
 class AssembleSourcePlugin(plugin.Plugin):
-	""" Reconstuct a source from its documents """
+	"""
+	Reconstuct a source from its documents.
+	The master's document ids are indexed when it arrives, arrivals are
+	counted against that index, and the documents are put in their places
+	in one pass once the last one shows up.
+	A master without a size gets the sum of its documents' source sizes
+	(each streamed fragment is sized on its own), and the loader's
+	newsource routing flag is taken off it.
+	"""
+	singleinstance = True
+
 	def Init(self, *args, **kwargs):
 		""" set up a tracking dict for master sources and member docs """
+		# source id -> {document id: document}
 		self.registry = {}
 		self.masters = {}
 
+		# source id -> {document id: position in the master}, and how many
+		# of those positions have a document waiting for them
+		self.slots = {}
+		self.arrived = {}
+
+		# source id -> the total of its documents' source sizes
+		self.sizes = {}
+
 	def canhandle(self, xjob):
 		""" if we can't reconstruct, push it along
 		first case:  master source
@@ -40,43 +59,39 @@ class AssembleSourcePlugin(plugin.Plugin):
 		srcid = srcnode.get('id')
 		docid = docnode.get('id')
 
-		# set up a convenience variable
-		master = None
+		registry = self.registry.setdefault(srcid, {})
 
-		# add a master to the pile
+		# add a master to the pile, indexing its documents and counting the
+		# ones that beat it here
 		if srcnode.get('reconstruct', False):
 			self.masters[srcid] = xjob
-
-		# there's a registry entry, so append to that
-		elif self.registry.has_key(srcid):
-			self.registry[srcid].append(docnode)
-
-		# create a new entry for this page
-		else: self.registry[srcid] = [docnode]
-
-
-		# yield if all page nodes are filled out in the master
-		if self.masters.has_key(srcid) and self.registry.has_key(srcid):
-			# set the convenience function
+			slots = self.slots[srcid] = dict([(child.get('id'), i)
+			                                  for i, child in enumerate(srcnode)])
+			self.arrived[srcid] = len([i for i in registry if slots.has_key(i)])
+
+		# count a document the master has a place for (the first time it shows)
+		else:
+			if self.slots.has_key(srcid) and self.slots[srcid].has_key(docid) and \
+			   not registry.has_key(docid):
+				self.arrived[srcid] += 1
+			if srcnode.get('size') is not None and not registry.has_key(docid):
+				self.sizes[srcid] = self.sizes.get(srcid, 0) + int(srcnode.get('size'))
+			registry[docid] = docnode
+
+		# try to yield the source, once every place in the master is spoken for
+		if self.masters.has_key(srcid) and self.arrived[srcid] == len(self.slots[srcid]):
 			master = self.masters[srcid].find('source')
-
-			# loop through the registry entries
-			for o in xrange(len(self.registry[srcid])):
-
-				# loop through the master entries (baseline documents)
-				for i in xrange(len(master)):
-
-					# this will die with an exception if no id exists
-					if master[i].get('id') == self.registry[srcid][o].get('id'):
-						master.remove(master[i])
-						master.insert(i, self.registry[srcid][o])
-						break
-
-
-		# try to yield the source
-		if master is not None and len(master) == len(self.registry[srcid]):
+			master[:] = [registry.get(child.get('id'), child) for child in list(master)]
 			del(master.attrib['reconstruct'])
+			if master.get('size') is None and self.sizes.has_key(srcid):
+				master.set('size', "%d" % self.sizes[srcid])
 			self.registry.pop(srcid)
+			self.slots.pop(srcid)
+			self.arrived.pop(srcid)
+			self.sizes.pop(srcid, None)
+
+			# (the flag only means something on the way in)
+			self.masters[srcid].attrib.pop('newsource', None)
 			yield self.masters.pop(srcid)
 
 		# reconstruction is not finished, so destroy this node
@@ -86,12 +101,22 @@ class AssembleDocumentPlugin(plugin.Plugin):
 	"""
 	Reconstitutes a document from (near) scratch by keying on its document id
 	and the reconstruct flag.
+	Pages are counted against an index of the master's empty pages, and
+	filled in one pass once they're all here.
 	"""
+	singleinstance = True
+
 	def Init(self, *args, **kwargs):
-		# set up a tracking dict
+		# set up a tracking dict (document id -> {page id: [pages, in arrival order]})
 		self.registry = {}
 		self.masters = {}
 
+		# document id -> {page id: [empty pages in the master]}, how many of
+		# those have a page to fill them, and how many there are in all
+		self.slots = {}
+		self.arrived = {}
+		self.expected = {}
+
 	def canhandle(self, xjob):
 		""" if we can't reconstruct, push it along """
 		return xjob.find('source/document') is not None and \
@@ -107,40 +132,38 @@ class AssembleDocumentPlugin(plugin.Plugin):
 		pgid = pgnode.get('id')
 		docid = docnode.get('id')
 
-		# set up a convenience variable
-		master = None
-
-		# add a master to the pile
-		if docnode.get('reconstruct', False): self.masters[docid] = xjob
-
-		# there's a registry entry, so append to that
-		elif self.registry.has_key(docid): self.registry[docid].append(pgnode)
-
-		# create a new entry for this page
-		else: self.registry[docid] = [pgnode]
-
-		# yield if all page nodes are filled out in the master
-		if self.masters.has_key(docid) and self.registry.has_key(docid):
-			# set the convenience function
+		registry = self.registry.setdefault(docid, {})
+
+		# add a master to the pile, indexing its empty pages and counting the
+		# pages that beat it here
+		if docnode.get('reconstruct', False):
+			self.masters[docid] = xjob
+			slots = self.slots[docid] = {}
+			for page in docnode.findall('.//page'):
+				if len(page) == 0: slots.setdefault(page.get('id'), []).append(page)
+			self.expected[docid] = sum([len(pages) for pages in slots.itervalues()])
+			self.arrived[docid] = sum([min(len(registry[i]), len(slots[i]))
+			                           for i in registry if slots.has_key(i)])
+
+		# count a page if there's still an empty page waiting for it
+		else:
+			arrivals = registry.setdefault(pgid, [])
+			arrivals.append(pgnode)
+			if self.slots.has_key(docid) and \
+			   len(arrivals) <= len(self.slots[docid].get(pgid, ())):
+				self.arrived[docid] += 1
+
+		# try to yield the document, filling the empty pages in one go
+		if self.masters.has_key(docid) and self.arrived[docid] == self.expected[docid]:
 			master = self.masters[docid].find('source/document')
+			for pageid, pages in self.slots[docid].iteritems():
+				for page, reg in zip(pages, registry.get(pageid, ())):
+					page.attrib = reg.attrib
+					for c in [a for a in list(reg) if a.tag != 'page']: page.append(c)
 
-			# loop through the registry entries
-			for reg in self.registry[docid]:
-
-				# loop through the master entries (baseline documents)
-				for page in master.getiterator('page'):
-
-					# this will die with an exception if no id exists
-					if page.get('id') == reg.get('id') and len(page) == 0:
-						page.attrib = reg.attrib
-						for c in [a for a in list(reg) if a.tag != 'page']: page.append(c)
-						break
-
-		# try to yield the source
-		if master is not None and \
-		    len(master.findall('.//page')) == len(self.registry[docid]):
 			del(master.attrib['reconstruct'])
-			self.registry.pop(docid)
+			for table in (self.registry, self.slots, self.arrived, self.expected):
+				table.pop(docid)
 			yield self.masters.pop(docid)
 
 		# reconstruction is not finished, so destroy this node
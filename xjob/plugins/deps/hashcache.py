@@ -0,0 +1,104 @@
+# A persistent cache of file digests, so re-ingested boxes skip rehashing
+#
+
+import os, json, threading
+from collections import OrderedDict
+
+class HashCache(object):
+	"""
+	Remembers the digests of files, keyed on what the file looked like when
+	it was hashed: (path, size, mtime, inode, digest name).  A file that's
+	been touched, replaced or moved gets a new key, so it's hashed again.
+	The least recently used entries go once there are more than maxentries.
+	The cache lives in memory and is written (whole, one JSON entry per line)
+	to its file on flush() and close().
+	"""
+	def __init__(self, filename, maxentries=500000):
+		self.filename = filename
+		self.maxentries = maxentries
+		self.lock = threading.Lock()
+
+		# key -> (size, digest), oldest use first
+		self.entries = OrderedDict()
+		self.dirty = False
+
+		if os.path.isfile(filename):
+			cachefile = open(filename, 'r')
+			try:
+				for line in cachefile:
+					# a torn last line from a crash is just ignored
+					try: entry = json.loads(line)
+					except ValueError: continue
+					self.entries[tuple(entry[:5])] = tuple(entry[5:])
+			finally: cachefile.close()
+
+			# the cap may have shrunk since it was written
+			while len(self.entries) > self.maxentries:
+				self.entries.popitem(last=False)
+
+	def key(self, filename, digest):
+		"""
+		Stat a file for its cache key.
+		Returns:
+			the key, or None if the file can't be stat'd
+		"""
+		try: stat = os.stat(filename)
+		except OSError: return None
+		return (os.path.abspath(filename), stat.st_size, stat.st_mtime,
+		        stat.st_ino, digest)
+
+	def lookup(self, key):
+		"""
+		Find a file's digest (marking it recently used).
+		Returns:
+			(size, digest), or None if it isn't cached
+		"""
+		if key is None: return None
+
+		self.lock.acquire()
+		try:
+			entry = self.entries.pop(key, None)
+			if entry is not None: self.entries[key] = entry
+			return entry
+		finally: self.lock.release()
+
+	def store(self, key, size, digest):
+		""" Remember a file's digest (dropping the oldest entries past the cap). """
+		if key is None: return
+
+		self.lock.acquire()
+		try:
+			self.entries.pop(key, None)
+			self.entries[key] = (size, digest)
+			while len(self.entries) > self.maxentries:
+				self.entries.popitem(last=False)
+			self.dirty = True
+		finally: self.lock.release()
+
+	def flush(self):
+		""" Write the cache out (if it's changed), replacing the old file. """
+		self.lock.acquire()
+		try:
+			if not self.dirty: return
+			lines = []
+			for key, entry in self.entries.iteritems():
+				# paths that aren't utf-8 just don't get remembered
+				try: lines.append(json.dumps(list(key) + list(entry)) + '\n')
+				except UnicodeDecodeError: continue
+			self.dirty = False
+		finally: self.lock.release()
+
+		# write beside the old one and swap it in
+		tempname = self.filename + '.tmp'
+		cachefile = open(tempname, 'w')
+		try:
+			cachefile.writelines(lines)
+			cachefile.flush()
+			os.fsync(cachefile.fileno())
+		finally: cachefile.close()
+
+		if os.path.exists(self.filename): os.remove(self.filename)
+		os.rename(tempname, self.filename)
+
+	def close(self):
+		self.flush()
@@ -0,0 +1,113 @@
+# A shared thread pool for page file I/O, limited and measured per storage root
+#
+
+import os, time, threading
+from multiprocessing.dummy import Pool
+
+class IOEngine(object):
+	"""
+	Runs page file operations for the Soak, Flush and hash stages on one
+	pool of threads, so slow (network) storage has many requests going at
+	once instead of one per stage thread.  At most perroot operations run
+	against any one storage root (drive, UNC share or mount point) at a time.
+	Operations are called as function(path, *args) and return
+	(bytes moved, result); the bytes go towards the root's throughput.
+	With no threads, operations run in the caller's thread (still measured).
+	"""
+	def __init__(self, threads=16, perroot=4):
+		if threads < 0 or perroot < 1:
+			raise ValueError("An IOEngine needs a thread count and a per-root limit")
+		self.perroot = perroot
+		self.pool = (threads and (Pool(threads),) or (None,))[0]
+		self.lock = threading.Lock()
+
+		# root -> Semaphore, and root -> [bytes, operations, active, busy since, busy time]
+		self.limits = {}
+		self.counters = {}
+
+		# directory -> root, to save walking up to the mount point every time
+		self.roots = {}
+
+	def root(self, path):
+		""" Get the storage root a path lives on. """
+		drive = os.path.splitdrive(path)[0]
+		if drive: return drive.lower()
+
+		directory = os.path.dirname(os.path.abspath(path))
+		root = self.roots.get(directory)
+		if root is None:
+			root = directory
+			while not os.path.ismount(root) and os.path.dirname(root) != root:
+				root = os.path.dirname(root)
+			self.roots[directory] = root
+		return root
+
+	def run(self, function, path, *args):
+		""" Run one operation under its root's limit, returning its result. """
+		root = self.root(path)
+
+		self.lock.acquire()
+		try:
+			limit = self.limits.get(root)
+			if limit is None:
+				limit = self.limits[root] = threading.Semaphore(self.perroot)
+				self.counters[root] = [0, 0, 0, 0.0, 0.0]
+			counter = self.counters[root]
+		finally: self.lock.release()
+
+		limit.acquire()
+		try:
+			self.__Busy(counter, 1)
+			try: count, result = function(path, *args)
+			finally: self.__Busy(counter, -1)
+		finally: limit.release()
+
+		self.lock.acquire()
+		try:
+			counter[0] += count
+			counter[1] += 1
+		finally: self.lock.release()
+		return result
+
+	def map(self, function, items):
+		"""
+		Run an operation over a list of argument tuples (path first).
+		Returns:
+			the results, in order
+		"""
+		if self.pool is None or len(items) < 2:
+			return [self.run(function, *item) for item in items]
+		return self.pool.map(lambda item: self.run(function, *item), items, 1)
+
+	def stats(self):
+		"""
+		Get the throughput of each root so far.
+		Returns:
+			{root: {'bytes':, 'operations':, 'seconds': (time with anything
+			 running), 'rate': (bytes/sec over that time)}}
+		"""
+		now = time.time()
+		self.lock.acquire()
+		try:
+			result = {}
+			for root, (count, operations, active, since, busy) in self.counters.iteritems():
+				if active: busy += now - since
+				result[root] = {'bytes':count, 'operations':operations, 'seconds':busy,
+				                'rate':(busy and (count / busy,) or (0.0,))[0]}
+			return result
+		finally: self.lock.release()
+
+	def close(self):
+		""" Shut down the I/O threads. """
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+
+	def __Busy(self, counter, change):
+		""" Track how long a root has had operations running. """
+		self.lock.acquire()
+		try:
+			if change > 0 and not counter[2]: counter[3] = time.time()
+			counter[2] += change
+			if not counter[2]: counter[4] += time.time() - counter[3]
+		finally: self.lock.release()
@@ -0,0 +1,125 @@
+# Spooled page payloads for Soak/Flush, and the budget that bounds them
+#
+
+import tempfile, threading, itertools
+
+class ByteBudget(object):
+	"""
+	A cap on how many payload bytes are in flight between a Soak and its
+	Flush.  acquire() blocks until the bytes fit; release() gives them back.
+	A request bigger than the whole budget waits for everything else to
+	drain and then goes through alone, so one huge document can't wedge it.
+	"""
+	def __init__(self, limit):
+		if limit <= 0: raise ValueError("A byte budget needs a positive limit")
+		self.limit = limit
+		self.inflight = 0
+		self.condition = threading.Condition()
+
+	def acquire(self, count, quitevent=None):
+		"""
+		Take count bytes from the budget, waiting for room if need be.
+		Returns:
+			True once they're taken, False if quitevent was set while waiting
+		"""
+		self.condition.acquire()
+		try:
+			while self.inflight and self.inflight + count > self.limit:
+				if quitevent is not None and quitevent.isSet(): return False
+				self.condition.wait(0.5)
+			self.inflight += count
+			return True
+		finally: self.condition.release()
+
+	def release(self, count):
+		""" Give count bytes back to the budget. """
+		self.condition.acquire()
+		try:
+			self.inflight -= count
+			self.condition.notifyAll()
+		finally: self.condition.release()
+
+class Payload(object):
+	"""
+	A page file's bytes on their way from Soak to Flush, copied in chunks
+	into a spool that stays in memory up to spoolsize and moves to a temp
+	file past it.  Whatever it holds of a budget goes back on close().
+	"""
+	def __init__(self, budget=None, reserved=0, spoolsize=1<<20):
+		self.budget = budget
+		self.reserved = reserved
+		self.size = 0
+		self.spool = tempfile.SpooledTemporaryFile(spoolsize, prefix="xjob-spool-")
+
+	def __len__(self):
+		return self.size
+
+	def fill(self, fileobj, chunksize=1<<20):
+		""" Copy the rest of a file object into the spool. """
+		while True:
+			data = fileobj.read(chunksize)
+			if not data: break
+			self.spool.write(data)
+			self.size += len(data)
+
+	def chunks(self, chunksize=1<<20):
+		""" A generator over the spooled bytes, from the start. """
+		self.spool.seek(0)
+		while True:
+			data = self.spool.read(chunksize)
+			if not data: break
+			yield data
+
+	def close(self):
+		""" Drop the spool and hand back our share of the budget (once). """
+		self.spool.close()
+		if self.budget is not None and self.reserved:
+			self.budget.release(self.reserved)
+		self.reserved = 0
+
+class PayloadTable(object):
+	"""
+	Payloads between Soak and Flush, kept to one side of the xjob (a node's
+	text has to stay a string for the tree to serialize) under keys that
+	Soak writes on the data nodes.  Any left over on close() -- from
+	documents that never made it to a Flush -- are closed then, so their
+	spools and budget don't leak.
+	"""
+	def __init__(self):
+		self.payloads = {}
+		self.keys = itertools.count()
+		self.lock = threading.Lock()
+
+	def __len__(self):
+		return len(self.payloads)
+
+	def __contains__(self, key):
+		return self.payloads.has_key(key)
+
+	def put(self, payload):
+		"""
+		Keep a payload until it's popped.
+		Returns:
+			its key (a string, for a data node's attribute)
+		"""
+		self.lock.acquire()
+		try:
+			key = str(self.keys.next())
+			self.payloads[key] = payload
+		finally: self.lock.release()
+		return key
+
+	def pop(self, key):
+		""" Take a payload back out (None if there's none under key). """
+		self.lock.acquire()
+		try: return self.payloads.pop(key, None)
+		finally: self.lock.release()
+
+	def close(self):
+		""" Close whatever payloads are left. """
+		self.lock.acquire()
+		try:
+			payloads = self.payloads.values()
+			self.payloads.clear()
+		finally: self.lock.release()
+		for payload in payloads: payload.close()
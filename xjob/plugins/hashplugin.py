@@ -2,7 +2,7 @@
 # Eric Ritezel -- February 25, 2007
 #
 
-import os, zlib
+import os, zlib, hashlib, threading
 
 # this mess finds the Plugin module
 try:
@@ -12,12 +12,88 @@ except KeyError:
 	import imp
 	plugin = imp.load_source('plugin', os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'plugin.py')))
 
+from deps.ioengine import IOEngine
+
+class Checksum(object):
+	"""
+	Running adler32/crc32 in the form HashNSizer has always written it
+	(hex() of the running value, started from 0).
+	"""
+	def __init__(self, function):
+		self.function = function
+		self.value = 0
+
+	def update(self, data):
+		self.value = self.function(data, self.value)
+
+	def hexdigest(self):
+		return hex(self.value)
+
+# digest name -> function making a fresh hash object
+digests = {'adler32': lambda: Checksum(zlib.adler32),
+           'crc32': lambda: Checksum(zlib.crc32),
+           'md5': hashlib.md5,
+           'sha1': hashlib.sha1}
+
+def Digest(filename, digest='adler32', buf=None):
+	"""
+	Read a file once, hashing it and counting its size
+	(into buf, a bytearray, if given; 1MB at a time otherwise).
+	Returns:
+		(size, checksum), with a size of None if the file can't be read
+	"""
+	if buf is None: buf = bytearray(1 << 20)
+
+	result = digests[digest]()
+	size = 0
+
+	try:
+		fp = open(filename, 'rb')
+		try:
+			while True:
+				count = fp.readinto(buf)
+				if not count: break
+				result.update(buffer(buf, 0, count))
+				size += count
+		finally: fp.close()
+	except (IOError, OSError): size = None
+
+	return size, result.hexdigest()
+
 class HashNSizerPlugin(plugin.Plugin):
 	"""
-	A Pipeline plugin to run an Adler32 fasthash transform by chunk
-	on page data (and document data if it exists)
+	A Pipeline plugin to run a digest (Adler32 unless told otherwise) by
+	chunk on page data (and document data if it exists), a few files at a
+	time on an IOEngine's threads (hashing doesn't hold the GIL).
 	Size is calculated during this process.
 	"""
+	def Init(self, *args, **kwargs):
+		# the digest to use: adler32, crc32, md5 or sha1
+		self.digest = kwargs.get('digest', 'adler32')
+		if not digests.has_key(self.digest):
+			raise ValueError("Unknown digest: " + str(self.digest))
+
+		# the files to read at once, and the size of each read
+		self.threads = int(kwargs.get('threads', 4))
+		self.chunksize = int(kwargs.get('chunksize', 1 << 20))
+		if self.threads < 1 or self.chunksize < 1:
+			raise ValueError("Hashing needs at least one thread and a chunk size")
+
+		# one read buffer per I/O thread, reused from file to file
+		self.buffers = threading.local()
+
+		# a shared IOEngine, or one of our own
+		self.io = kwargs.get('ioengine')
+		self.ownio = self.io is None
+		if self.ownio: self.io = IOEngine(self.threads, self.threads)
+
+		# a HashCache of files we've hashed before (optional)
+		self.cache = kwargs.get('hashcache')
+
+	def on_end(self):
+		""" Shut down the hashing threads (if they're ours). """
+		if self.ownio: self.io.close()
+
 	def canhandle(self, xjob):
 		""" See if we can actually run the hasher. """
 		firstpagedata = xjob.find('.//page/data')
@@ -38,40 +114,58 @@ class HashNSizerPlugin(plugin.Plugin):
 		basepath = sourcenode.attrib['href']
 		if not os.path.isdir(basepath): basepath = os.path.dirname(basepath)
 
+		# get the data nodes and their files
+		datanodes = [page.find('data') for page in xjob.getiterator("page")]
+		filenames = [os.path.join(basepath, datanode.attrib['path'],
+		                          datanode.attrib['filename'])
+		             for datanode in datanodes]
+
 		# get file sizing information for box
 		boxsize = 0
 
-		for page in xjob.getiterator("page"):
-			# get the data node
-			datanode = page.find('data')
-			filename = os.path.join(basepath, datanode.attrib['path'],
-									datanode.attrib['filename'])
-
-			try:
-				# compute adler32 checksum of file (chunked read)
-				filehash = 0
-				try:
-					# attach size info to file and add to box counter
-					size = os.stat(filename).st_size
-					datanode.attrib['size'] = "%d" % size
-					boxsize += size
-
-					fp = open(filename, "rb")
-					while True:
-						data = fp.read(65534)
-						if not data: break
-						filehash = zlib.adler32(data, filehash)
-
-				# attach a missing flag and move on
-				except: datanode.attrib['missing'] = 'True'
-
-				# close the file pointer
-				finally:fp.close()
+		# hash on the I/O threads, but write the results down here
+		results = self.io.map(self.__Hash, [(filename,) for filename in filenames])
+		for datanode, (size, checksum) in zip(datanodes, results):
+			# attach size info to file and add to box counter
+			if size is not None:
+				datanode.attrib['size'] = "%d" % size
+				boxsize += size
+
+			# attach a missing flag and move on
+			else: datanode.attrib['missing'] = 'True'
 
 			# throw checksum onto file
-			finally: datanode.attrib['checksum'] = hex(filehash)
+			datanode.attrib['checksum'] = checksum
 
 		# set box size and checksum
 		sourcenode.attrib['size'] = "%d" % boxsize
 
-		yield xjob
\ No newline at end of file
+		yield xjob
+
+	def Hash(self, filename):
+		"""
+		Read a file once, hashing it and counting its size (unless the cache
+		has it from the last time the file looked like this).
+		Returns:
+			(size, checksum), with a size of None if the file can't be read
+		"""
+		return self.__Hash(filename)[1]
+
+	def __Hash(self, filename):
+		""" Hash as an IOEngine operation: (bytes read, (size, checksum)). """
+		if self.cache is not None:
+			key = self.cache.key(filename, self.digest)
+			entry = self.cache.lookup(key)
+			if entry is not None: return 0, entry
+
+		# get this thread's read buffer
+		buf = getattr(self.buffers, 'buf', None)
+		if buf is None: buf = self.buffers.buf = bytearray(self.chunksize)
+
+		size, checksum = Digest(filename, self.digest, buf)
+
+		# only complete reads are worth remembering
+		if self.cache is not None and size is not None:
+			self.cache.store(key, size, checksum)
+
+		return size or 0, (size, checksum)
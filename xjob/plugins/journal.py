@@ -0,0 +1,183 @@
+# Checkpoint/resume Plugins for long OutputPipeline runs
+#
+
+import os, json, threading, xml.etree.ElementTree as ET
+
+# this mess finds the Plugin module
+try:
+	import sys
+	plugin = sys.modules['plugin']
+except KeyError:
+	import imp
+	plugin = imp.load_source('plugin', os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'plugin.py')))
+
+from hashplugin import Digest
+
+class Journal(object):
+	"""
+	An append-only, per-document completion journal.
+	Each line is a JSON record of a finished document:
+		{"key": <document key (see Key)>, "settings": <settings digest>,
+		 "temphref": <where its files went>,
+		 "files": [[<output file>, <adler32 checksum>], ...],
+		 "document": <the finished <document> element, serialized>}
+	Later lines for the same document win.
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self.lock = threading.Lock()
+
+		# document key -> raw journal line (parsed when it's asked for)
+		self.entries = {}
+		if os.path.isfile(filename):
+			journal = open(filename, 'r')
+			try:
+				for line in journal:
+					# a torn last line from a crash is just ignored
+					try: self.entries[json.loads(line)['key']] = line
+					except (ValueError, KeyError): continue
+			finally: journal.close()
+
+		self.journal = open(filename, 'a')
+
+	def lookup(self, key, settings):
+		"""
+		Find the record of a finished document, if it's still good.
+		Returns:
+			the record dict, or None if the document wasn't finished under these
+			settings (by digest) or any of its output files are missing or changed
+		"""
+		self.lock.acquire()
+		try: line = self.entries.get(key)
+		finally: self.lock.release()
+		if line is None: return None
+
+		record = json.loads(line)
+		if record.get('settings') != settings: return None
+
+		# verify every output file against its checksum
+		for filename, checksum in record['files']:
+			if not os.path.isfile(filename) or Digest(filename)[1] != checksum:
+				return None
+
+		return record
+
+	def record(self, key, settings, temphref, files, document):
+		"""
+		Write a document's completion to the journal (and to disk).
+		Once the journal's closed, this is a no-op (the document just won't
+		be skipped next time).
+		"""
+		line = json.dumps({'key':key, 'settings':settings, 'temphref':temphref,
+		                   'files':files, 'document':ET.tostring(document)}) + '\n'
+
+		self.lock.acquire()
+		try:
+			if self.journal is None: return
+			self.journal.write(line)
+			self.journal.flush()
+			os.fsync(self.journal.fileno())
+			self.entries[key] = line
+		finally: self.lock.release()
+
+	def close(self):
+		""" Close the journal (stages still writing to it are ignored). """
+		self.lock.acquire()
+		try:
+			if self.journal is not None: self.journal.close()
+			self.journal = None
+		finally: self.lock.release()
+
+def Key(srcnode, docnode):
+	"""
+	A document's journal key: its source's href and its first page's
+	captured Bates number (or else its name as loaded).  Document ids are
+	made fresh every run, so they can't be used to find it again.
+	"""
+	page = docnode.find('.//page')
+	if page is None: return srcnode.get('href')
+
+	bates = [number.get('value') for number in page.findall('number')
+	         if number.get('type') == 'bates']
+	first = (bates and (bates[0],) or (page.get('oldname', page.get('name')),))[0]
+	return "%s|%s" % (srcnode.get('href'), first)
+
+def _Document(xjob):
+	""" Get the single document of a per-document xjob (or None). """
+	if xjob.find('source') is None or \
+	   xjob.find('source').get('reconstruct', 'False') == 'True': return None
+	documents = xjob.findall('source/document')
+	return (len(documents) == 1 and (documents[0],) or (None,))[0]
+
+class ResumePlugin(plugin.Plugin):
+	"""
+	Swaps in the journaled result for documents a previous run finished
+	(under the same settings, with their files intact) and flags
+	their xjob complete, so the processing stages pass them along.
+	The journaled document takes this run's id (so it reassembles into this
+	run's source) and keeps its own temphref.
+	Belongs right after ProcessByDocumentPlugin.
+	"""
+	def Init(self, *args, **kwargs):
+		self.journal = kwargs.get('journal')
+		self.settings = kwargs.get('settings')
+		if self.journal is None or self.settings is None:
+			raise ValueError("Resume needs a journal and a settings argument")
+
+	def canhandle(self, xjob):
+		""" Only per-document xjobs that haven't been finished already. """
+		return xjob.get('complete', None) is None and _Document(xjob) is not None
+
+	def handle(self, level, xjob):
+		""" Replace the document with its journaled self, if it checks out. """
+		srcnode = xjob.find('source')
+		docnode = srcnode.find('document')
+		record = self.journal.lookup(Key(srcnode, docnode),
+		                             self.settings.getdigest())
+
+		if record is not None:
+			finished = ET.fromstring(record['document'].encode('utf-8'))
+			for name in ('id', 'parent'):
+				if docnode.get(name) is not None: finished.set(name, docnode.get(name))
+			finished.set('temphref', record['temphref'])
+
+			srcnode.remove(docnode)
+			srcnode.append(finished)
+			srcnode.set('temphref', record['temphref'])
+			xjob.set('complete', 'True')
+
+		yield xjob
+
+class CheckpointPlugin(plugin.Plugin):
+	"""
+	Journals each finished document with the checksums of its output files.
+	Belongs after the last stage that writes page files (EmbedPlugin).
+	"""
+	def Init(self, *args, **kwargs):
+		self.journal = kwargs.get('journal')
+		self.settings = kwargs.get('settings')
+		if self.journal is None or self.settings is None:
+			raise ValueError("Checkpoint needs a journal and a settings argument")
+
+	def canhandle(self, xjob):
+		""" Only per-document xjobs this run actually produced. """
+		return xjob.get('complete', None) is None and _Document(xjob) is not None
+
+	def handle(self, level, xjob):
+		""" Checksum the document's output files and write it down. """
+		srcnode = xjob.find('source')
+		docnode = srcnode.find('document')
+		basepath = docnode.get('temphref', srcnode.get('temphref', srcnode.get('href')))
+
+		# the files live where FlushPlugin put them
+		files = []
+		for node in docnode.getiterator('data'):
+			filepath = os.path.join(basepath,
+			                        node.get('oldpath', node.get('path')),
+			                        node.get('oldfilename', node.get('filename')))
+			files.append([filepath, Digest(filepath)[1]])
+
+		self.journal.record(Key(srcnode, docnode), self.settings.getdigest(),
+		                    basepath, files, docnode)
+
+		yield xjob
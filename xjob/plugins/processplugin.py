@@ -53,6 +53,9 @@ class ProcessByPagePlugin(plugin.Plugin):
 	"""
 	Breaks a document down into its component pages.
 	This function includes metadata for its direct parent document and source
+	Each page moves its own children into its xjob.  Its ancestors' tags,
+	attributes and (stripped) children are read once per source, and every
+	page's xjob gets its own copies of them built from that.
 	"""
 	blocks = ('page', 'document', 'attachment')
 
@@ -65,41 +68,36 @@ class ProcessByPagePlugin(plugin.Plugin):
 
 	def handle(self, level, xjob):
 		""" Generate pages """
-		# create a parent map (via effbot, who would know)
-		parent_map = dict((c, p) for p in xjob.getiterator() for c in p)
-
 		# create a source node
 		srcnode = xjob.find('source')
 
-		# iterate all page nodes for yielding
-		for page in xjob.getiterator('page'):
-			# create a temporary xjob
-			tempxjob = ET.Element('xjob', xjob.attrib)
+		# ancestor -> its shell: (tag, attributes, [(tag, attributes) of its
+		# stripped children]), read once (each page copies from it)
+		shells = {}
 
-			# create a temporary source
+		# iterate all page nodes (and their ancestors) for yielding
+		for page, ancestors in self.__Walk(srcnode, ()):
+			# create a temporary xjob and source (with their own attributes)
+			tempxjob = ET.Element('xjob', xjob.attrib)
 			tempsrc = ET.SubElement(tempxjob, 'source', srcnode.attrib)
 
-			# create a list of nodes to push crap to
-			tempnode = page
-			lasttemp = None
+			# the page itself, with its own children (except for extraneous hierarchy)
+			lasttemp = ET.Element(page.tag, page.attrib)
+			lasttemp.extend([n for n in list(page) if n.tag not in ProcessByPagePlugin.blocks])
 
 			# walk up until we get to the source (so we can push all pages)
-			while tempnode is not srcnode:
-				# create a new element with the given attributes
-				newnode = ET.Element(tempnode.tag, tempnode.attrib)
-
-				# append children (except for extraneous hierarchy)
-				for node in [n for n in list(tempnode) if n.tag not in ProcessByPagePlugin.blocks]:
-					ET.SubElement(newnode, node.tag, node.attrib)
-
-				# append hierarchy and walk
-				if lasttemp is not None:
-					newnode.append(lasttemp)
+			for ancestor in reversed(ancestors):
+				if not shells.has_key(ancestor):
+					shells[ancestor] = (ancestor.tag, ancestor.attrib,
+					                    [(n.tag, n.attrib) for n in list(ancestor)
+					                     if n.tag not in ProcessByPagePlugin.blocks])
+				tag, attrib, children = shells[ancestor]
+
+				newnode = ET.Element(tag, attrib)
+				newnode.extend([ET.Element(ctag, cattrib) for ctag, cattrib in children])
+				newnode.append(lasttemp)
 				lasttemp = newnode
 
-				# get the parent of the temporary node
-				tempnode = parent_map[tempnode]
-
 			# append to temporary source node
 			tempsrc.append(lasttemp)
 
@@ -113,3 +111,13 @@ class ProcessByPagePlugin(plugin.Plugin):
 			for child in list(page): page.remove(child)
 
 		yield xjob
+
+	def __Walk(self, node, ancestors):
+		"""
+		Find the pages under a node (in document order), along with their
+		ancestors below the source (outermost first).
+		"""
+		for child in node:
+			if child.tag == 'page': yield child, ancestors
+			if len(child):
+				for found in self.__Walk(child, ancestors + (child,)): yield found
@@ -28,12 +28,32 @@ class RenderPlugin(plugin.Plugin):
 		# set up the revision (force the first instance to pull)
 		self.revision = -1
 
+		# a SourceManager to look order numbers up in (optional)
+		self.manager = kwargs.get('manager')
+
+	def ordinal(self, node, deep=False):
+		"""
+		Get a page or document's order number: from the manager's index if
+		it has the node, otherwise from its <order> node.
+		Parameters:
+			deep -- go by the first order node under the node (for a document,
+			        that of its first page) like './/order' does
+		"""
+		if self.manager is not None:
+			value = self.manager.GetOrder((deep and (next(node.iter('page'), node),) or (node,))[0].get('id'))
+			if value is not None: return value
+
+		return int(node.find((deep and ('.//order',) or ('order',))[0]).get('value'))
+
 class RenderDirectory(RenderPlugin):
 	"""
 	If the xjob does not have a complete flag set on it, run.
 	The complete flag means that the xjob is coming through and all
 	the finalization stages have been completed before.
 	"""
+	# directory numbering carries over from one item to the next
+	singleinstance = True
+
 	def Init(self, *args, **kwargs):
 		""" Set up some state variables. """
 		self.diridx = 1
@@ -50,22 +70,24 @@ class RenderDirectory(RenderPlugin):
 	def handle(self, level, xjob):
 		""" The greatest plugin ever. """
 		# see if our settings revision checks out, fetch settings otherwise
-		rev = int(self.settings.getrevision())
+		# (all from one snapshot, so they agree with each other and the revision)
+		settings = self.settings.snapshot()
+		rev = int(settings.revision)
 		if self.revision != rev:
 			self.revision = rev
 
 			# chain through directorty settings by popularity
-			if self.settings['directory/Custom'] is not None:
-				self.userdir = int(self.settings['directory/User'])
+			if settings['directory/Custom'] is not None:
+				self.userdir = int(settings['directory/User'])
 			else:
 				self.userdir = None
-				if self.settings['directory/JFS'] is not None:
+				if settings['directory/JFS'] is not None:
 					self.usejfs = True
-				elif self.settings['directory/Box'] is not None:
+				elif settings['directory/Box'] is not None:
 					self.boxdir = True
 
 			# handle summation limit (don't split documents across directories)
-			self.summation = self.settings['loadfiles/Summation'] is not None
+			self.summation = settings['loadfiles/Summation'] is not None
 
 		# if "directory by box" is set, pull from the source's name
 		# FIXME: can be extended to any element, I believe
@@ -85,7 +107,7 @@ class RenderDirectory(RenderPlugin):
 
 			# determine directory break
 			dbreak = dbreak or self.userdir and not self.boxdir and \
-			         not (int(node.find('.//order').get('value')) % self.userdir)
+			         not (self.ordinal(node, True) % self.userdir)
 
 			# if user-defined page limits are used, test for the limit
 			# NOTE: Summation does not like a document's pages to be split
@@ -144,28 +166,39 @@ class RenderDirectory(RenderPlugin):
 
 class RenderNumbering(RenderPlugin):
 	""" A plugin to handle document numbering """
+	# the numbering masks are worked out once, so one instance has to do them all
+	singleinstance = True
+	batchsize = 32
+
 	def canhandle(self, xjob):
-		""" See if we can handle the job (we need a number node """
-		return xjob.get('complete', None) is None
+		""" See if we can handle the job (we need pages, and not a master's stubs) """
+		return xjob.get('complete', None) is None and \
+		       xjob.find('source') is not None and \
+		       xjob.find('source').get('reconstruct', 'False') != 'True' and \
+		       xjob.find('.//page') is not None
 
 	def handle(self, level, xjob):
 		""" Run!  Run for your life! """
 		# see if our settings revision checks out, fetch settings otherwise
-		rev = self.settings.getrevision()
+		settings = self.settings.snapshot()
+		rev = settings.revision
 		if self.revision != rev:
 			self.revision = rev
 
 			# see if we're doing a custom name job
-			self.idlogic = self.settings['page/Custom'] is not None
+			self.idlogic = settings['page/Custom'] is not None
 
 			# get a number (either a number node or the first page name)
 
 			# fetch the mask to be used
-			if self.idlogic: mask = PageFileMask(self.settings['page/CustomName'])
-			else:# defaults to the first number node, then name
-				firstnum = xjob.find('.//number')
-				if firstnum is not None: firstnum = firstnum.get('value')
-				else: firstnum = xjob.find('.//page').get('name')
+			if self.idlogic: mask = PageFileMask(settings['page/CustomName'])
+			else:# defaults to the job's first number (see OutputPipeline.run)
+				firstnum = xjob.get('firstnumber')
+
+				# then this xjob's first number node, then name
+				if firstnum is None and xjob.find('.//number') is not None:
+					firstnum = xjob.find('.//number').get('value')
+				if firstnum is None: firstnum = xjob.find('.//page').get('name')
 				mask = PageFileMask(firstnum)
 
 			# calculate the length of the number of the first id
@@ -184,7 +217,7 @@ class RenderNumbering(RenderPlugin):
 					# FIXME: this makes me so sick.
 					def with_suffix(page, document):
 						""" gets the suffix and document number if needed """
-						docorder = int(document.find('order').get('value'))
+						docorder = self.ordinal(document)
 
 						result = self.prefix
 						result += ('%' + self.idlength + 'd') % (docorder + mask.num)
@@ -196,14 +229,14 @@ class RenderNumbering(RenderPlugin):
 
 					self.idlogic = with_suffix
 				else:
-					self.idlogic = lambda p, d: self.prefix + ('%'+self.idlength+'d') % (int(p.find('order').get('value')) + mask.num)
+					self.idlogic = lambda p, d: self.prefix + ('%'+self.idlength+'d') % (self.ordinal(p) + mask.num)
 
 			# tack on first id number
-			elif self.settings['page/SameAsID'] is not None:
+			elif settings['page/SameAsID'] is not None:
 				self.idlogic = lambda p, _: [b.get('value') for b in p.findall('number') if b.get('type', 0) == 'did'][0]
 
 			# tack on first Bates number
-			elif self.settings['page/SameAsCapturedBates'] is not None:
+			elif settings['page/SameAsCapturedBates'] is not None:
 				self.idlogic = lambda p, _: [b.get('value') for b in p.findall('number') if b.get('type', 0) == 'bates'][0]
 
 			# stick to whatever junk is in the name field
@@ -211,16 +244,16 @@ class RenderNumbering(RenderPlugin):
 
 			# FILE NAME SETTINGS SECTION
 			# see if we're referring to the page name for this
-			if self.settings['file/SameAsPageName']:
+			if settings['file/SameAsPageName']:
 				self.filelogic = lambda p, d: self.idlogic(p, d) + \
 				                 p.find('data').get('filename').split('.')[-1]
 
 			# see if we've got our own custom mask
-			elif self.settings['file/Custom']:
-				filemask = PageFileMask(self.settings['file/CustomName'])
+			elif settings['file/Custom']:
+				filemask = PageFileMask(settings['file/CustomName'])
 				self.filelogic = lambda p, d: self.prefix + \
 				                 ('%' + str(len(filemask.getNumber())) + 'd') % \
-				                 (int(p.find('order').get('value')) + filemask.num) + \
+				                 (self.ordinal(p) + filemask.num) + \
 				                 p.find('data').get('filename').split('.')[-1]
 
 			# stick to whatever junk is in the datanode's filename field
@@ -268,21 +301,25 @@ class RenderNumbering(RenderPlugin):
 
 class RenderVolume(RenderPlugin):
 	""" A plugin to handle the output of a volume """
+	# volume boundaries carry over from one item to the next
+	singleinstance = True
+
 	def handle(self, level, xjob):
 		""" Reassemble and write out a new volume """
 		# see if our settings revision checks out, fetch settings otherwise
-		rev = self.settings.getrevision()
+		settings = self.settings.snapshot()
+		rev = settings.revision
 		if self.revision != rev:
 			self.revision = rev
 
 			# get the volume name and size
-			self.vname = self.settings['output/VolumeMask']
-			self.vsize = self.settings['output/Media']
+			self.vname = settings['output/VolumeMask']
+			self.vsize = settings['output/Media']
 
 			# get the translated, fulltext and native file storage locations
-			self.transfiles = self.settings['export/TranslatedDirectory']
-			self.fulltext = self.settings['export/FulltextDirectory']
-			self.natives = self.settings['export/NativeDirectory']
+			self.transfiles = settings['export/TranslatedDirectory']
+			self.fulltext = settings['export/FulltextDirectory']
+			self.natives = settings['export/NativeDirectory']
 
 			# set the loadfile generation scheme
 			self.loadfiles = self.settings.section('loadfiles')
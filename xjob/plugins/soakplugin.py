@@ -2,7 +2,7 @@
 # Eric Ritezel -- February 28, 2007
 #
 
-import os, xml.etree.ElementTree as ET
+import os, shutil, xml.etree.ElementTree as ET
 
 try:
 	import sys
@@ -11,18 +11,75 @@ except KeyError:
 	import imp
 	plugin = imp.load_source('plugin', os.path.realpath(os.path.join(os.path.dirname(__file__), '..', 'plugin.py')))
 
+from deps.spool import Payload
+from deps.ioengine import IOEngine
+
+# copy-on-write clones (Linux FICLONE), where the platform has them
+try:
+	import fcntl
+	_FICLONE = 0x40049409
+except ImportError: _FICLONE = None
+
+def Transfer(source, destination):
+	"""
+	Copy a file without pulling it through Python: a copy-on-write clone
+	if the filesystem does them, a plain copy if not.
+	(Hard links would be cheaper, but later stages rewrite page files in
+	place, which would go straight through to the originals.)
+	"""
+	if os.path.abspath(source) == os.path.abspath(destination): return
+
+	if _FICLONE is not None:
+		srcfile = open(source, 'rb')
+		try:
+			dstfile = open(destination, 'wb')
+			try:
+				fcntl.ioctl(dstfile.fileno(), _FICLONE, srcfile.fileno())
+				return
+			except IOError: pass
+			finally: dstfile.close()
+		finally: srcfile.close()
+
+	shutil.copyfile(source, destination)
+
+def _Soaked(datanode):
+	""" Whether Soak's been at a data node (whatever it found there). """
+	return datanode.get('reference') is not None or \
+	       datanode.get('spooled') is not None or datanode.text is not None
+
 class SoakPlugin(plugin.Plugin):
 	"""
-	A plugin that reads page data from the filesystem
-	and appends it using base64 encoding to the data node.
+	A plugin that reads page data from the filesystem into a spooled
+	Payload, kept in a PayloadTable (payloads=) under the data node's
+	spooled attribute, or as the node's text if there's no table.
 	Useful for over-the-wire transfers.
 	Preferably done per-document.
+	With transfer='reference' (for when Flush runs on the same filesystem)
+	it only notes where each file is, and Flush copies the file itself.
+	A ByteBudget (budget=) holds Soak back while too much data is in flight.
+	Files are read on a shared IOEngine (ioengine=) if there is one.
 	"""
+	def Init(self, *args, **kwargs):
+		""" Pick the transfer mode: 'data' (in the node) or 'reference' """
+		self.transfer = kwargs.get('transfer', 'data')
+		if self.transfer not in ('data', 'reference'):
+			raise ValueError("Unknown transfer mode: " + str(self.transfer))
+
+		# payloads stay in memory up to spoolsize, and are copied chunksize at a time
+		self.budget = kwargs.get('budget')
+		self.payloads = kwargs.get('payloads')
+		self.spoolsize = kwargs.get('spoolsize', 1<<20)
+		self.chunksize = kwargs.get('chunksize', 1<<20)
+		self.io = kwargs.get('ioengine') or IOEngine(0)
+
 	def canhandle(self, xjob):
 		""" Disallow two soaks on a page. """
+		# finished (resumed) documents don't need their data
+		if xjob.get('complete', None) is not None: return False
+
 		for pagedata in xjob.findall('.//page/data'):
-			if pagedata is not None and pagedata.text is not None:
-				if __debug__: print "failing?", ET.tostring(pagedata)
+			if _Soaked(pagedata):
+				if __debug__: print "failing?", pagedata.attrib
 				return False
 
 		# test and see if the document data has already been soaked
@@ -34,46 +91,83 @@ class SoakPlugin(plugin.Plugin):
 		srcnode = xjob.find('source')
 		basepath = srcnode.get('temphref', srcnode.get('href'))
 
-		# throw data into each node we find
-		for node in xjob.getiterator('data'):
-			# get a filepath combo
-			filepath = os.path.join(basepath, \
-			           node.get('oldpath', node.get('path')),\
-			           node.get('oldfilename', node.get('filename')))
-
-			# write and dump to node
-			datfile = open(filepath, 'rb')
-			node.text = datfile.read()#.encode('zip').encode('base64')
-			datfile.close()
+		# get a filepath combo for each data node we find
+		files = [(node, os.path.join(basepath,
+		                             node.get('oldpath', node.get('path')),
+		                             node.get('oldfilename', node.get('filename'))))
+		         for node in xjob.getiterator('data')]
+
+		# just point at the files if Flush can get to them
+		if self.transfer == 'reference':
+			for node, filepath in files:
+				node.set('reference', os.path.abspath(filepath))
+			yield xjob
+			return
+
+		# take the whole document's worth of budget at once (page by page, a
+		# document bigger than the budget would wait on itself)
+		sizes = [os.path.getsize(filepath) for node, filepath in files]
+		reserved = (self.budget is not None and (sum(sizes),) or (0,))[0]
+		if reserved and not self.budget.acquire(reserved, self.quitevent): return
+
+		# each payload carries its own share of the reservation back
+		payloads = [Payload(self.budget, (reserved and (size,) or (0,))[0], self.spoolsize)
+		            for size in sizes]
+
+		# spool the files all at once, and drop them all if one fails
+		try: self.io.map(self.__Fill, [(filepath, payload) for (node, filepath), payload
+		                               in zip(files, payloads)])
+		except:
+			for payload in payloads: payload.close()
+			raise
+
+		# put the payloads in the table, or their bytes in the nodes without one
+		for (node, filepath), payload in zip(files, payloads):
+			if self.payloads is not None:
+				node.set('spooled', self.payloads.put(payload))
+			else:
+				node.text = ''.join(payload.chunks())
+				payload.close()
 
 		# yield the xjob back
 		yield xjob
 
+	def __Fill(self, filepath, payload):
+		""" Spool a file into its payload (an IOEngine operation). """
+		datfile = open(filepath, 'rb')
+		try: payload.fill(datfile, self.chunksize)
+		finally: datfile.close()
+		return len(payload), payload
+
 class FlushPlugin(plugin.Plugin):
 	"""
-	A plugin that writes the base64-encoded contents of data nodes to
-	the filesystem at a specified location
+	A plugin that writes the soaked contents of data nodes (a Payload from
+	the PayloadTable given as payloads=, the node's text, or a referenced
+	file) to the filesystem at a specified location
 	Useful for over-the-wire transfers.
 	Preferably done per-document.
+	Files are written on a shared IOEngine (ioengine=) if there is one.
+	Each document is marked with the temphref its files went to, so it
+	still knows once it's back in a source that may hold other runs' work.
 	"""
 	def Init(self, *args, **kwargs):
 		""" initialize a tracking sequence for documents """
 		# below we default to the xjob's uuid
 		self.tempdir = (kwargs.has_key('tempdir') and (kwargs['tempdir'],) or (0,))[0]
 		self.cleanup = kwargs.has_key('cleanup')
+		self.payloads = kwargs.get('payloads')
+		self.io = kwargs.get('ioengine') or IOEngine(0)
 
 	def canhandle(self, xjob):
-		""" Confirm that there's soaked data to be flushed from the nodes. """
-		# see if the document data node exists, but is not populated
-		docdata = xjob.find('.//document/data')
-		if docdata is not None:
-			if __debug__: print "failing on doc flush?", len(docdata.text)
-			return len(docdata.text) > 0
-
-		# see if all of the pages have data
-		for pagedata in xjob.findall('.//page/data'):
-			if pagedata.text is None or len(pagedata.text) == 0:
-				if __debug__: print "failing on page flush?", len(pagedata.text)
+		"""
+		Confirm that every data node has been soaked (an empty file's soaked
+		too -- turning it down would strand its payload).
+		"""
+		if xjob.get('complete', None) is not None: return False
+
+		for datanode in xjob.getiterator('data'):
+			if not _Soaked(datanode):
+				if __debug__: print "failing on flush?", datanode.attrib
 				return False
 
 		return True
@@ -83,26 +177,57 @@ class FlushPlugin(plugin.Plugin):
 		srcnode = xjob.find('source')
 		if self.tempdir: srcnode.set('temphref', self.tempdir)
 		basepath = srcnode.get('temphref', srcnode.get('href'))
-
-		# throw data into each node we find
-		for node in xjob.getiterator('data'):
-			# get a filepath combo
-			filepath = os.path.join(basepath,
-			                   node.get('oldpath', node.get('path')),\
-			                   node.get('oldfilename', node.get('filename')))
-
-			# create filepath if it doesn't exist
-			if not os.path.exists(os.path.dirname(filepath)):
-				os.makedirs(os.path.dirname(filepath))
-
-			# write data to it
-			datafile = open(filepath, 'wb')
-			datafile.write(node.text)#.decode('base64').decode('zip'))
-			datafile.close()
-
+		for docnode in srcnode.getiterator('document'): docnode.set('temphref', basepath)
+
+		# get a filepath combo for each data node we find
+		files = [(os.path.join(basepath,
+		                       node.get('oldpath', node.get('path')),
+		                       node.get('oldfilename', node.get('filename'))), node)
+		         for node in xjob.getiterator('data')]
+
+		# create filepaths that don't exist (here, so the writers don't race)
+		for directory in set([os.path.dirname(filepath) for filepath, node in files]):
+			if not os.path.exists(directory): os.makedirs(directory)
+
+		# claim every payload first, so they all get closed even if a write fails
+		payloads = []
+		for filepath, node in files:
+			key = node.get('spooled')
+			payloads.append((key is not None and self.payloads is not None and
+			                 (self.payloads.pop(key),) or (None,))[0])
+
+		# write them all out at once, then clear the nodes
+		try: self.io.map(self.__Write, [(filepath, node, payload) for
+		                                (filepath, node), payload in zip(files, payloads)])
+		finally:
+			for payload in payloads:
+				if payload is not None: payload.close()
+
+		for filepath, node in files:
+			for key in ('reference', 'spooled'):
+				if node.get(key) is not None: del node.attrib[key]
 			node.text = None
 
 		# yield the xjob back
 		yield xjob
 
+	def __Write(self, filepath, node, payload):
+		""" Write out one data node (an IOEngine operation). """
+		# copy a referenced file straight over
+		if node.get('reference') is not None:
+			Transfer(node.get('reference'), filepath)
+			return os.path.getsize(filepath), None
+
+		# write data to it (a chunk at a time, freeing its budget after)
+		datafile = open(filepath, 'wb')
+		try:
+			if payload is not None:
+				for data in payload.chunks(): datafile.write(data)
+			elif node.text: datafile.write(node.text)
+		finally:
+			datafile.close()
+			if payload is not None: payload.close()
+
+		return os.path.getsize(filepath), None
+
 
@@ -6,11 +6,13 @@
 #	-> __init__()
 #	-> __getitem__()
 #	-> __setitem__()
+#	-> snapshot()
+#	-> getdigest()
 #	-> findall()
 
 import xml.etree.ElementTree as ET
 
-import uuid, threading
+import uuid, threading, hashlib
 
 class Settings (object):
 	"""
@@ -31,6 +33,9 @@ class Settings (object):
 		# set up a thread lock
 		self.session = threading.RLock()
 
+		# the flattened settings, as of some revision
+		self._snapshot = None
+
 	def __setitem__(self, index, value):
 		"""
 		A setter method for the settings class (now with pythonic semantics)
@@ -89,22 +94,30 @@ class Settings (object):
 		finally: self.session.release()
 
 	def __getitem__(self, index):
-		""" Ignore thread safety and just start grabbing data """
-    	# make sure the access is valid
-		if isinstance(index, tuple) and len(index) == 2:
-			branch, node = index
-		elif isinstance(index, str) and index.find('/') != -1:
-			branch, node = index.split('/', 2)
-		else: raise ValueError("Incorrect index for settings access.")
+		""" Read a value from the current snapshot (None if it's not set) """
+		return self.snapshot()[index]
 
-		# return the first value that occurs (None if there's an error)
-		try:
-			rv = self._settings.getiterator(branch)[0].getiterator(node)[0]
-			if rv.text: result = rv.text
-			else: result = True
-		except: result = None
+	def snapshot(self):
+		"""
+		Public:
+			Get an unchanging copy of the settings as of the current revision
+			(rebuilt only when the revision moves on).
+			Read a batch of settings from one snapshot to get a consistent set.
+		Returns:
+			A SettingsSnapshot
+		"""
+		snapshot = self._snapshot
+		if snapshot is not None and snapshot.revision == self._settings.attrib['rev']:
+			return snapshot
 
-		return result
+		# rebuild it (writers hold the lock while they change the tree)
+		self.session.acquire()
+		try:
+			snapshot = self._snapshot
+			if snapshot is None or snapshot.revision != self._settings.attrib['rev']:
+				snapshot = self._snapshot = SettingsSnapshot(self._settings)
+			return snapshot
+		finally: self.session.release()
 
 	def section(self, param):
 		"""
@@ -124,9 +137,69 @@ class Settings (object):
 
 		return result
 
+	def __getstate__(self):
+		""" Pickle support (for process pools): ship the tree, not the lock """
+		self.session.acquire()
+		try: result = ET.tostring(self._settings)
+		finally: self.session.release()
+		return result
+
+	def __setstate__(self, state):
+		""" Rebuild the tree and a fresh lock from a pickled tree """
+		self._settings = ET.fromstring(state)
+		self.session = threading.RLock()
+		self._snapshot = None
+
 	def getrevision(self):
 		""" Revision accessor for version checking """
 		self.session.acquire()
 		try: result = self._settings.attrib['rev']
 		finally: self.session.release()
-		return result
\ No newline at end of file
+		return result
+
+	def getdigest(self):
+		"""
+		Content accessor for comparing settings across sessions (revisions
+		start over every session; the digest only changes with the values)
+		"""
+		return self.snapshot().digest
+
+class SettingsSnapshot (object):
+	"""
+	A read-only, flattened copy of a settings tree at one revision.
+	Lookups give what Settings used to find walking the tree: the first
+	<node> under the first <branch>, its text (or True if it has none).
+	digest is an MD5 of those values, the same for the same settings.
+	"""
+	__slots__ = ('revision', 'digest', '_values')
+
+	def __init__(self, settings):
+		values = {}
+		branches = {}
+
+		# the first element with each tag is the branch for it
+		for section in settings.getiterator():
+			if branches.has_key(section.tag): continue
+			branches[section.tag] = True
+
+			# ...and the first element with each tag under it is the node
+			for child in section.getiterator():
+				values.setdefault((section.tag, child.tag), child.text or True)
+
+		object.__setattr__(self, 'revision', settings.attrib['rev'])
+		object.__setattr__(self, 'digest', hashlib.md5(repr(sorted(values.items()))).hexdigest())
+		object.__setattr__(self, '_values', values)
+
+	def __getitem__(self, index):
+		""" Look up a value by (branch, node) or 'branch/node' (None if unset) """
+		# make sure the access is valid
+		if isinstance(index, tuple) and len(index) == 2:
+			branch, node = index
+		elif isinstance(index, str) and index.find('/') != -1:
+			branch, node = index.split('/', 2)
+		else: raise ValueError("Incorrect index for settings access.")
+
+		return self._values.get((branch, node))
+
+	def __setattr__(self, name, value):
+		raise AttributeError("Settings snapshots can't be changed")
@@ -10,9 +10,10 @@
 # 	AddSource(XML)
 # 	RemoveSource(uuid)
 # 	GetOrderedXJOB()
+# 	GetOrder(uuid)
 #
 
-import xml.etree.ElementTree as ET
+import bisect, threading, xml.etree.ElementTree as ET
 
 class SourceManager:
 	def __init__(self):
@@ -20,11 +21,35 @@ class SourceManager:
 		Public:
 			Creates a new SourceManager
 		"""
-		# a list of Volumes sorted by id
+		# the sources in order, with their (sort key, arrival) index alongside
+		self.__sources = []
+		self.__keys = []
+
+		# source id -> (sort key, arrival)
+		self.__ids = {}
+
+		# arrival counter (ties in sort key go in arrival order)
+		self.__arrivals = 0
+
+		# ordering state: source id -> (pages, documents) it holds and the
+		# (page, document) base it was last numbered from, the first position
+		# that may need renumbering, and page/document id -> order number
+		self.__counts = {}
+		self.__bases = {}
+		self.__dirty = 0
+		self.__orders = {}
+
+		# the xjob built from the sources (None when it needs rebuilding) and
+		# its attributes (None until the first xjob comes in)
+		self.__attrib = None
 		self.__xjob = None
 
+		# keep the index consistent between the pipeline and the GUI
+		self.__lock = threading.RLock()
+
 		# set up the sorting parameter (xpath, attrib)
 		self.sortby = ('source', 'name')
+		self.__keyfcn = self.__KeyFunction(self.sortby)
 
 	def AddSource(self, xjob, sortby=None):
 		"""
@@ -34,7 +59,7 @@ class SourceManager:
 			xjob -- the ElementTree representation of the source to add
 			sortby -- the xpath/attrib pair to sort the insertion by
 		Returns:
-			A copy of the xjob
+			The source node added
 		"""
 		# make sure we've got a source
 		if xjob.find('source') is None:
@@ -45,30 +70,32 @@ class SourceManager:
 			if isinstance(sortby, tuple) and len(sortby)!=2:
 				raise ValueError("Got invalid sorting parameter")
 
-			# set our sortby for this
-			self.sortby = sortby
+		self.__lock.acquire()
+		try:
+			# set our sortby for this (and re-sort what we have by it)
+			if sortby is not None and sortby != self.sortby:
+				self.sortby = sortby
+				self.__keyfcn = self.__KeyFunction(sortby)
+				self.__Reindex()
 
+			# the first xjob in brings its attributes and all its sources,
+			# the rest bring their first source
+			if self.__attrib is None:
+				self.__attrib = dict(xjob.attrib)
+				sources = list(xjob.findall('source'))
+			else: sources = [xjob.find('source')]
 
-		# append incoming xjob
-		if self.__xjob is not None:
-			self.__xjob.append(xjob.find('source'))
-		else: self.__xjob = xjob
-	
-		# pull data from sortby
-		sortpath, sortattrib = self.sortby
+			# work out the keys before touching the index
+			keys = [self.__keyfcn(source) for source in sources]
 
-		# determine sorting function
-		if sortpath.find('/') > -1:
-			keyfcn = lambda x:str(x.find('/'.join(sortpath.split('/')[1:])).get(sortattrib))
-		else: keyfcn = lambda x:str(x.get(sortattrib))
+			for key, source in zip(keys, sources):
+				self.__Insert((key, self.__arrivals), source)
+				self.__arrivals += 1
 
-		# rebuild xjob index
-		newxjob = ET.Element('xjob', self.__xjob.attrib)
-		for node in sorted(list(self.__xjob), key=keyfcn): newxjob.append(node)
-		self.__xjob = newxjob
+			self.__xjob = None
+			return sources[0]
+		finally: self.__lock.release()
 
-		return self.__xjob
-	
 	def RemoveSource(self, sourceid):
 		"""
 		Public:
@@ -77,21 +104,30 @@ class SourceManager:
 		Parameters:
 			sourceid -- the id of the source to be extracted.
 		Returns:
-			A copy of the xjob
+			The source node removed
 		"""
-		# search for volume
-		removeidx = None
-		for i in xrange(len(self.__xjob)):
-			if self.__xjob[i].get('id') == str(sourceid):
-				removeidx = i ; break
-				
-		# trash out if not found
-		if removeidx is None: raise ValueError("Source does not exist")
-
-		# remove source from main list
-		self.__xjob.remove(self.__xjob[removeidx])
-		
-		return self.__xjob
+		self.__lock.acquire()
+		try:
+			# trash out if not found
+			if not self.__ids.has_key(str(sourceid)):
+				raise ValueError("Source does not exist")
+
+			# remove source from main list
+			index = bisect.bisect_left(self.__keys, self.__ids.pop(str(sourceid)))
+			del self.__keys[index]
+			source = self.__sources.pop(index)
+
+			# drop its numbering (everything after it moves up)
+			self.__counts.pop(str(sourceid), None)
+			if self.__bases.pop(str(sourceid), None) is not None:
+				for node in source.getiterator():
+					if node.tag in ('page', 'document'):
+						self.__orders.pop(node.get('id'), None)
+			self.__dirty = min(self.__dirty, index)
+
+			self.__xjob = None
+			return source
+		finally: self.__lock.release()
 
 	def GetSourceOrder(self):
 		"""
@@ -100,30 +136,117 @@ class SourceManager:
 		Returns:
 			An n-tuple of strings
 		"""
-		return tuple([n.get('id') for n in list(self.__xjob)])
+		self.__lock.acquire()
+		try: return tuple([n.get('id') for n in self.__sources])
+		finally: self.__lock.release()
 
 	def GetOrderedXJOB(self):
 		"""
 		Public:
 			Generates a monolithic XJOB with <order> nodes on the docs/pages
+			Only the sources from the first one added or moved since the
+			last call on are renumbered (and only if their numbering changed);
+			sources are taken to be unchanged once they're added.
 		Returns:
 			One XJOB please
 		"""
-		page = document = 0
-		for node in self.__xjob.getiterator():
-			# skip non-page/doc nodes
-			if node.tag not in ('page', 'document'): continue
-
-			# remove preexisting order nodes
-			while node.find('order') is not None:
-				node.remove(node.find('order'))
-			
-			# add an ordering node
+		self.__lock.acquire()
+		try:
+			xjob = self.__Build()
+
+			# pick up the numbering where it's still good
+			page = document = 0
+			if self.__dirty > 0:
+				last = self.__sources[self.__dirty - 1].get('id')
+				page, document = self.__bases[last]
+				page += self.__counts[last][0]
+				document += self.__counts[last][1]
+
+			for source in self.__sources[self.__dirty:]:
+				srcid = source.get('id')
+				if self.__bases.get(srcid) != (page, document):
+					self.__Number(source, page, document)
+
+				page += self.__counts[srcid][0]
+				document += self.__counts[srcid][1]
+
+			self.__dirty = len(self.__sources)
+			return xjob
+		finally: self.__lock.release()
+
+	def GetOrder(self, nodeid):
+		"""
+		Public:
+			Gets the order number of a page or document as of the last
+			GetOrderedXJOB (the value of its <order> node)
+		Parameters:
+			nodeid -- the id of the page or document
+		Returns:
+			An integer, or None if it hasn't been numbered
+		"""
+		return self.__orders.get(nodeid)
+
+	# --------------------------------------------------------------------
+	# Index upkeep
+
+	def __KeyFunction(self, sortby):
+		""" Build the function that gets a source's sort key. """
+		sortpath, sortattrib = sortby
+
+		# determine sorting function
+		if sortpath.find('/') > -1:
+			subpath = '/'.join(sortpath.split('/')[1:])
+			return lambda x:str(x.find(subpath).get(sortattrib))
+		return lambda x:str(x.get(sortattrib))
+
+	def __Insert(self, key, source):
+		""" Put a source into the index at its sorted place. """
+		index = bisect.bisect_right(self.__keys, key)
+		self.__keys.insert(index, key)
+		self.__sources.insert(index, source)
+		self.__ids[source.get('id')] = key
+		self.__dirty = min(self.__dirty, index)
+
+	def __Reindex(self):
+		""" Re-sort everything by the current key (ties keep their order). """
+		sources = self.__sources
+		self.__sources, self.__keys, self.__ids = [], [], {}
+		for arrival, source in enumerate(sources):
+			self.__Insert((self.__keyfcn(source), arrival), source)
+
+	def __Number(self, source, page, document):
+		""" Number a source's pages and documents on from the given base. """
+		self.__bases[source.get('id')] = (page, document)
+		base = (page, document)
+
+		for node in source.getiterator():
+			# count pages and documents (skip everything else)
 			if node.tag == 'page':
 				page += 1
-				ET.SubElement(node, 'order', value=str(page))
-			else:
+				value = page
+			elif node.tag == 'document':
 				document += 1
-				ET.SubElement(node, 'order', value=str(document))
-
-		return self.__xjob
+				value = document
+			else: continue
+
+			# reuse the order node if it's where we'd have put it (last)
+			order = node.find('order')
+			if order is not None and order is not node[-1]:
+				node.remove(order)
+				order = None
+			if order is None: order = ET.SubElement(node, 'order')
+			order.set('value', str(value))
+
+			self.__orders[node.get('id')] = value
+
+		self.__counts[source.get('id')] = (page - base[0], document - base[1])
+
+	def __Build(self):
+		""" Get the xjob holding every source in order (built as needed). """
+		self.__lock.acquire()
+		try:
+			if self.__xjob is None:
+				self.__xjob = ET.Element('xjob', self.__attrib)
+				self.__xjob[:] = self.__sources
+			return self.__xjob
+		finally: self.__lock.release()